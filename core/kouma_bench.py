@@ -0,0 +1,269 @@
+# core/kouma_bench.py
+# 降魔ソルバーの回帰ベンチマーク。決まった盤面集（コーパス）を全モードで解き、
+# 処理時間・nodes/sec と、全探索の結果との差（最適性ギャップ）を JSON で残す。
+# 探索を変えたら実行前後の JSON を compare で比べ、速くなったか・答えが変わっていないかを見る。
+# ランダム盤面の生成と、並列・盤面サイズ・mcts と beam の個別の比較もここに置く
+# （キーの差分更新・盤面のコンパイルだけを測る bench_zobrist / bench_compile はソルバー側にある）。
+#
+#   python -m core.kouma_bench run -o before.json
+#   python -m core.kouma_bench run -o after.json
+#   python -m core.kouma_bench compare before.json after.json
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+from typing import Dict, List
+
+from core import kouma_game
+
+MODES = ("memo", "nomemo", "beam", "mcts", "parallel")
+
+# 全探索（参照解）の上限。7x7 の合成盤面は全探索に数分以上かかるので打ち切り、
+# その盤面のギャップは「参照解が最適と証明できていない」印をつけて出す
+REFERENCE_MAX_STEPS = 2000000
+
+def random_board_rows(width=7, height=7, seed=0, obstacle_density=0.15, zako_density=0.35, bosses=3, boss_hp=(3, 10), treasures=2, crystals=1) -> List[str]:
+    """ベンチマーク用のランダム盤面（board_from_rows 形式の行）。同じ引数なら同じ盤面になる。"""
+    rng = random.Random(seed)
+    cells = [(x, y) for y in range(height) for x in range(width)]
+    rng.shuffle(cells)
+    grid = [["."] * width for _ in range(height)]
+    it = iter(cells)
+    x, y = next(it)
+    grid[y][x] = "P"
+    for _ in range(bosses):
+        x, y = next(it)
+        grid[y][x] = f"B{rng.randint(*boss_hp)}"
+    for _ in range(treasures):
+        x, y = next(it)
+        grid[y][x] = f"T_{rng.choice('RGBY')}{rng.randint(2, 6)}"
+    for _ in range(crystals):
+        x, y = next(it)
+        grid[y][x] = "C"
+    for x, y in it:
+        r = rng.random()
+        if r < obstacle_density:
+            grid[y][x] = "X"
+        elif r < obstacle_density + zako_density:
+            grid[y][x] = rng.choice("RGBY")
+    return [" ".join(row) for row in grid]
+
+# 参照解が数秒で最適と証明できる小さめのランダム盤面 (幅, 高さ, シード, ボス数)
+RANDOM_SPECS = [
+    (5, 5, 0, 2),
+    (5, 5, 1, 2),
+    (5, 5, 2, 2),
+    (6, 6, 1, 3),
+]
+
+def random_corpus(specs=RANDOM_SPECS, **knobs) -> Dict[str, List[str]]:
+    """random_board_rows で作るシード固定の盤面集。knobs は密度・ボス HP・宝箱数などをそのまま渡す。"""
+    corpus = {}
+    for w, h, seed, bosses in specs:
+        corpus[f"random-{w}x{h}-s{seed}"] = random_board_rows(w, h, seed=seed, bosses=bosses, **knobs)
+    return corpus
+
+def default_corpus() -> Dict[str, List[str]]:
+    # 手で作った 7x7 の合成盤面 + 参照解が出るランダム盤面。実際に遊んだ盤面は入っていないので、
+    # 実盤面で測るときは read_boards 形式のファイルを --corpus で渡す
+    corpus = {f"synthetic-{name}": rows for name, rows in kouma_game.DEFAULT_BOARDS.items()}
+    corpus.update(random_corpus())
+    return corpus
+
+def load_corpus(path: str) -> Dict[str, List[List[kouma_game.Cell]]]:
+    """read_boards 形式（JSON lines または空行区切りのグリッド）のファイルから盤面集を読む。"""
+    with open(path, encoding="utf-8") as f:
+        return {str(name): board for name, board in kouma_game.read_boards(f)}
+
+def score(best) -> dict:
+    b = best[0] if best else None
+    return {"bosses": b.boss_killed if b else 0, "length": b.length if b else 0}
+
+def run_board(board, modes=MODES, max_steps=200000, beam_width=300, time_budget_ms=None, reference_max_steps=REFERENCE_MAX_STEPS) -> dict:
+    cb = kouma_game.compile_board(board)
+    t0 = time.perf_counter()
+    best, stats = kouma_game.simulate_board(cb, mode="memo", max_steps=reference_max_steps)
+    ref = score(best)
+    ref["proven_optimal"] = stats["proven_optimal"]
+    ref["ms"] = int((time.perf_counter() - t0) * 1000)
+    row = {"size": f"{cb.width}x{cb.height}", "reference": ref, "modes": {}}
+    for mode in modes:
+        t0 = time.perf_counter()
+        best, stats = kouma_game.simulate_board(cb, mode=mode, max_steps=max_steps, beam_width=beam_width, time_budget_ms=time_budget_ms)
+        sec = time.perf_counter() - t0
+        s = score(best)
+        row["modes"][mode] = {
+            "ms": int(sec * 1000),
+            "nodes_visited": stats["nodes_visited"],
+            "nodes_per_sec": int(stats["nodes_visited"] / sec) if sec > 0 else 0,
+            **s,
+            # 参照解との差（0 なら同じ答え。負なら参照解が打ち切りで、こちらの方が良かった）
+            "gap_bosses": ref["bosses"] - s["bosses"],
+            "gap_length": ref["length"] - s["length"] if s["bosses"] == ref["bosses"] else None,
+            "proven_optimal": stats["proven_optimal"],
+        }
+    return row
+
+def summarize(boards: dict, modes) -> dict:
+    summary = {}
+    for mode in modes:
+        rows = [b["modes"][mode] for b in boards.values() if mode in b["modes"]]
+        if not rows:
+            continue
+        total_ms = sum(r["ms"] for r in rows)
+        summary[mode] = {
+            "total_ms": total_ms,
+            "nodes_per_sec": int(sum(r["nodes_visited"] for r in rows) * 1000 / total_ms) if total_ms > 0 else 0,
+            "optimal_boards": sum(1 for r in rows if r["gap_bosses"] <= 0 and (r["gap_length"] or 0) <= 0),
+            "boards": len(rows),
+        }
+    return summary
+
+def run_benchmark(corpus=None, modes=MODES, max_steps=200000, beam_width=300, time_budget_ms=None, reference_max_steps=REFERENCE_MAX_STEPS) -> dict:
+    """corpus（名前 -> 行のリストまたは parse 済みの盤面）を全モードで解き、JSON にできる dict を返す。"""
+    corpus = default_corpus() if corpus is None else corpus
+    boards = {}
+    for name, board in corpus.items():
+        if board and isinstance(board[0], str):
+            board = kouma_game.board_from_rows(board)
+        boards[name] = run_board(board, modes=modes, max_steps=max_steps, beam_width=beam_width,
+                                 time_budget_ms=time_budget_ms, reference_max_steps=reference_max_steps)
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "max_steps": max_steps,
+            "beam_width": beam_width,
+            "time_budget_ms": time_budget_ms,
+            "reference_max_steps": reference_max_steps,
+        },
+        "boards": boards,
+        "summary": summarize(boards, modes),
+    }
+
+def compare(old: dict, new: dict) -> dict:
+    """2 回分の run_benchmark の結果を比べる。モードごとの速度比と、答え（ボス数・経路長）が変わった盤面を返す。"""
+    result = {"speedup": {}, "changed": []}
+    for mode, s in new["summary"].items():
+        o = old["summary"].get(mode)
+        if o and s["total_ms"] > 0:
+            result["speedup"][mode] = round(o["total_ms"] / s["total_ms"], 2)
+    for name, b in new["boards"].items():
+        ob = old["boards"].get(name)
+        if ob is None:
+            continue
+        for mode, r in b["modes"].items():
+            o = ob["modes"].get(mode)
+            if o is not None and (o["bosses"], o["length"]) != (r["bosses"], r["length"]):
+                result["changed"].append({"board": name, "mode": mode, "old": [o["bosses"], o["length"]], "new": [r["bosses"], r["length"]]})
+    return result
+
+# --------------------
+# 個別の比較ベンチマーク（並列のスケーリング・盤面サイズ・mcts と beam）
+# --------------------
+def bench_parallel(worker_counts=(1, 2, 4, 8), max_steps=200000, split_depth=2, boards=None):
+    """parallel モードのスケーリングを測る。盤面ごと・ワーカー数ごとの処理時間と
+    逐次 memo に対する速度比を返す。"""
+    boards = kouma_game.DEFAULT_BOARDS if boards is None else boards
+    results = {"cpu_count": os.cpu_count()}
+    for name, rows in boards.items():
+        cb = kouma_game.compile_board(kouma_game.board_from_rows(rows))
+        t0 = time.perf_counter()
+        best, _ = kouma_game.simulate_board(cb, mode="memo", max_steps=max_steps)
+        serial_s = time.perf_counter() - t0
+        row = {"serial_ms": int(serial_s * 1000), "serial_bosses": best[0].boss_killed if best else 0}
+        for w in worker_counts:
+            t0 = time.perf_counter()
+            best, stats = kouma_game.simulate_board(cb, mode="parallel", max_steps=max_steps, workers=w, split_depth=split_depth)
+            sec = time.perf_counter() - t0
+            row[f"workers_{w}"] = {
+                "ms": int(sec * 1000),
+                "speedup": round(serial_s / sec, 2) if sec > 0 else 0,
+                "bosses": best[0].boss_killed if best else 0,
+                "length": best[0].length if best else 0,
+                "proven_optimal": stats["proven_optimal"],
+            }
+        results[name] = row
+    return results
+
+def bench_scaling(sizes=(7, 8, 9, 10, 11, 12), modes=("nomemo", "memo", "beam"), max_steps=50000, seed=0):
+    """盤面サイズを 7x7 から 12x12 まで変えたときの各モードの処理時間・nodes/sec・結果を返す。"""
+    results = {}
+    for size in sizes:
+        cb = kouma_game.compile_board(kouma_game.board_from_rows(random_board_rows(size, size, seed=seed, bosses=max(3, size // 2))))
+        row = {}
+        for mode in modes:
+            t0 = time.perf_counter()
+            best, stats = kouma_game.simulate_board(cb, mode=mode, max_steps=max_steps)
+            sec = time.perf_counter() - t0
+            row[mode] = {
+                "ms": int(sec * 1000),
+                "nodes_per_sec": int(stats["nodes_visited"] / sec) if sec > 0 and stats["nodes_visited"] >= 0 else None,
+                "bosses": best[0].boss_killed if best else 0,
+                "length": best[0].length if best else 0,
+            }
+        results[f"{size}x{size}"] = row
+    return results
+
+def bench_mcts_vs_beam(budgets_ms=(100, 500, 2000), sizes=(7, 10, 12), seeds=(0, 1, 2), beam_width=300):
+    """同じ制限時間で mcts と beam を比べる。盤面ごとの (ボス数, 経路長) と勝敗数を返す。"""
+    results = {}
+    for budget in budgets_ms:
+        row = {"mcts_wins": 0, "beam_wins": 0, "draws": 0, "boards": []}
+        for size in sizes:
+            for seed in seeds:
+                cb = kouma_game.compile_board(kouma_game.board_from_rows(random_board_rows(size, size, seed=seed, bosses=max(3, size // 2))))
+                scores = {}
+                for mode in ("mcts", "beam"):
+                    best, stats = kouma_game.simulate_board(cb, mode=mode, max_steps=10 ** 9, beam_width=beam_width, time_budget_ms=budget)
+                    b = best[0]
+                    scores[mode] = (b.boss_killed, b.length, stats["search_time_ms"])
+                m, bm = scores["mcts"][:2], scores["beam"][:2]
+                key = "mcts_wins" if m > bm else "beam_wins" if bm > m else "draws"
+                row[key] += 1
+                row["boards"].append({"size": size, "seed": seed, **scores})
+        results[f"{budget}ms"] = row
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m core.kouma_bench", description="降魔ソルバーのベンチマークを取り、結果を JSON で出力・比較する")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="コーパスを全モードで解く")
+    run.add_argument("--corpus", default=None, help="盤面ファイル（read_boards 形式）。省略時は既定のコーパス")
+    run.add_argument("--modes", default=",".join(MODES), help="カンマ区切りのモード")
+    run.add_argument("--max-steps", type=int, default=200000)
+    run.add_argument("--beam-width", type=int, default=300)
+    run.add_argument("--time-budget-ms", type=int, default=None)
+    run.add_argument("--reference-max-steps", type=int, default=REFERENCE_MAX_STEPS)
+    run.add_argument("-o", "--output", default="-", help="出力先。省略時は標準出力")
+    cmp = sub.add_parser("compare", help="2 つの結果 JSON を比べる")
+    cmp.add_argument("old")
+    cmp.add_argument("new")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.old, encoding="utf-8") as f:
+            old = json.load(f)
+        with open(args.new, encoding="utf-8") as f:
+            new = json.load(f)
+        json.dump(compare(old, new), sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+        return
+
+    corpus = load_corpus(args.corpus) if args.corpus else None
+    result = run_benchmark(corpus, modes=tuple(args.modes.split(",")), max_steps=args.max_steps, beam_width=args.beam_width,
+                           time_budget_ms=args.time_budget_ms, reference_max_steps=args.reference_max_steps)
+    text = json.dumps(result, ensure_ascii=False, indent=2) + "\n"
+    if args.output == "-":
+        sys.stdout.write(text)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+# core/kouma_cache.py
+# 降魔の解キャッシュ。盤面を回転・反転（二面体群）で正規化してから引くので、
+# 同じ盤面だけでなく鏡像・回転した盤面の再実行も即座に返せる。
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from core import kouma_game
+
+# 鏡像・回転で変わるのは座標だけなので、保存する経路数は控えめにする
+CACHE_MAX_PATHS = 100
+# キーの先頭につける形式・ソルバーの版。探索や保存形式を変えて古い解を使えなくなったら上げる
+CACHE_VERSION = 1
+# プロセス内に持つエントリ数の上限（最近使った順に残す）。7x7 で経路が多いと 1 件 100 KB 近くになる
+CACHE_MEMORY_ENTRIES = 128
+# ディスクキャッシュの上限。合計サイズを超えるか古くなったファイルから消す
+CACHE_DISK_MAX_MB = 64
+CACHE_DISK_MAX_AGE_DAYS = 30
+# put の何回に 1 回ディスクの掃除をするか
+CACHE_PRUNE_EVERY = 32
+DEFAULT_CACHE_DIR = os.environ.get("KOUMA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "kouma_game"))
+
+# (x, y, w, h) -> 変換後の (x, y)。変換後の盤面サイズは SWAPS_DIMS のものだけ (h, w) になる
+TRANSFORMS = [
+    lambda x, y, w, h: (x, y),
+    lambda x, y, w, h: (h - 1 - y, x),
+    lambda x, y, w, h: (w - 1 - x, h - 1 - y),
+    lambda x, y, w, h: (y, w - 1 - x),
+    lambda x, y, w, h: (w - 1 - x, y),
+    lambda x, y, w, h: (x, h - 1 - y),
+    lambda x, y, w, h: (y, x),
+    lambda x, y, w, h: (h - 1 - y, w - 1 - x),
+]
+SWAPS_DIMS = {1, 3, 6, 7}
+
+def cell_token(cell: kouma_game.Cell) -> str:
+    # boss_index は走査順で決まり向きに依存するので含めない
+    return f"{cell.type.value}:{cell.color or ''}:{cell.hp}"
+
+def transform_board(board, t: int):
+    h = len(board)
+    w = len(board[0]) if h else 0
+    tw, th = (h, w) if t in SWAPS_DIMS else (w, h)
+    out = [[None] * tw for _ in range(th)]
+    for y in range(h):
+        for x in range(w):
+            nx, ny = TRANSFORMS[t](x, y, w, h)
+            out[ny][nx] = board[y][x]
+    return out
+
+def canonicalize(board) -> Tuple[str, int]:
+    """(正規形の文字列, 元の盤面からその正規形への変換番号) を返す。"""
+    h = len(board)
+    w = len(board[0]) if h else 0
+    best_sig = None
+    best_t = 0
+    for t in range(len(TRANSFORMS)):
+        if t in SWAPS_DIMS and w != h:
+            continue
+        sig = "/".join(",".join(cell_token(c) for c in row) for row in transform_board(board, t))
+        if best_sig is None or sig < best_sig:
+            best_sig = sig
+            best_t = t
+    return best_sig, best_t
+
+def map_path(path, t: int, w: int, h: int, inverse: bool = False) -> List[Tuple[int, int]]:
+    forward = {(x, y): TRANSFORMS[t](x, y, w, h) for y in range(h) for x in range(w)}
+    table = {v: k for k, v in forward.items()} if inverse else forward
+    return [table[tuple(p)] for p in path]
+
+class SolutionCache:
+    """プロセス内 dict とディスク（JSON ファイル）の 2 段キャッシュ。cache_dir=None ならメモリのみ。
+    プロセス内は最近使った max_entries 件だけ残し、ディスクは max_disk_mb・max_age_days を超えた分を古い順に消す。"""
+
+    def __init__(self, cache_dir: Optional[str] = DEFAULT_CACHE_DIR, max_entries: int = CACHE_MEMORY_ENTRIES,
+                 max_disk_mb: float = CACHE_DISK_MAX_MB, max_age_days: float = CACHE_DISK_MAX_AGE_DAYS):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_bytes = int(max_disk_mb * 1024 * 1024)
+        self.max_age_s = max_age_days * 86400
+        self.memory: Dict[str, dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _remember(self, key: str, entry: dict):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _load(self, key: str) -> Optional[dict]:
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+            return entry
+        if self.cache_dir is None:
+            return None
+        path = self._file(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age_s:
+                os.remove(path)
+                return None
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            # 使ったファイルは新しい扱いにして、掃除で消されにくくする
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def get(self, *keys: str) -> Optional[dict]:
+        """keys を順に引き、最初に見つかったエントリを返す。何個のキーを引いてもヒット・ミスは 1 回と数える。"""
+        entry = None
+        for key in keys:
+            entry = self._load(key)
+            if entry is not None:
+                break
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key: str, entry: dict):
+        self._remember(key, entry)
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = self._file(key) + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp, self._file(key))
+        except OSError:
+            # ディスクに書けなくてもプロセス内キャッシュは効く
+            return
+        if self._puts % CACHE_PRUNE_EVERY == 0:
+            self.prune_disk()
+        self._puts += 1
+
+    def prune_disk(self) -> int:
+        """max_age_days より古いファイルを消し、合計が max_disk_mb を超える分を古い順に消す。消した数を返す。"""
+        if self.cache_dir is None:
+            return 0
+        files = []
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for e in it:
+                    if e.is_file() and e.name.endswith(".json"):
+                        st = e.stat()
+                        files.append((st.st_mtime, st.st_size, e.path))
+        except OSError:
+            return 0
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        now = time.time()
+        removed = 0
+        for mtime, size, path in files:
+            if now - mtime <= self.max_age_s and total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+_default_cache = None
+
+def default_cache() -> SolutionCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = SolutionCache()
+    return _default_cache
+
+def _proven_key(sig: str, top_k) -> str:
+    # 最適と証明された解は探索条件によらないが、保持する経路数（top_k）が違うと経路の本数が変わる
+    return f"v{CACHE_VERSION}|{sig}|{top_k}"
+
+def _param_key(sig: str, mode, max_steps, beam_width, time_budget_ms, top_k) -> str:
+    return f"v{CACHE_VERSION}|{sig}|{mode}|{max_steps}|{beam_width}|{time_budget_ms}|{top_k}"
+
+def simulate_board_cached(board, cache: Optional[SolutionCache] = None, solver=None, **kwargs):
+    """simulate_board の前段に置くキャッシュ。最適性が証明された解は保持経路数 top_k ごとに探索条件によらず共有し、
+    打ち切られた解は探索条件ごとに保存する。返り値の形式は simulate_board と同じ。
+    solver を渡すとキャッシュミス時に simulate_board の代わりに solver(board, **kwargs) を呼ぶ。"""
+    cache = default_cache() if cache is None else cache
+    solver = kouma_game.simulate_board if solver is None else solver
+    h = len(board)
+    w = len(board[0]) if h else 0
+    sig, t = canonicalize(board)
+    top_k = kwargs.get("top_k", kouma_game.BEST_K)
+    proven_key = _proven_key(sig, top_k)
+    param_key = _param_key(sig, kwargs.get("mode", "memo"), kwargs.get("max_steps", 200000),
+                           kwargs.get("beam_width", 300), kwargs.get("time_budget_ms"), top_k)
+
+    entry = cache.get(proven_key, param_key)
+    if entry is not None:
+        cb = kouma_game.compile_board(board)
+        best = []
+        for p in entry["paths"]:
+            state = kouma_game.replay_path(cb, map_path(p, t, w, h, inverse=True))
+            if state is not None:
+                best.append(state)
+        if best:
+            stats = dict(entry["stats"])
+            stats["boss_mask"] = best[0].boss_mask
+            stats["cache_hit"] = True
+            return best, stats
+
+    best, stats = solver(board, **kwargs)
+    paths = [map_path(s.path, t, w, h) for s in best[:CACHE_MAX_PATHS]]
+    stored = {k: v for k, v in stats.items() if k != "boss_mask"}
+    # 途中でキャンセルした結果は探索条件を変えなくても再現しないので保存しない
+    if not stats.get("cancelled"):
+        cache.put(proven_key if stats.get("proven_optimal") else param_key, {"paths": paths, "stats": stored})
+    stats["cache_hit"] = False
+    return best, stats
@@ -2,18 +2,39 @@
 from enum import Enum
 from typing import Optional, List, Tuple
 import time
-import heapq
+import itertools
+import bisect
+import math
+import json
+import sys
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import random
+import threading
+import tracemalloc
+from collections import deque
 
-random.seed(0)
-ZOBRIST = [[random.getrandbits(64) for _ in range(7)] for _ in range(7)]
+# セル番号 (y * width + x) ごとの Zobrist 乱数。盤面サイズに合わせて必要な分だけ伸ばす
+# （固定シードの列の先頭から使うので、どのサイズでも同じセル番号には同じ値が入る）
+_zobrist_rng = random.Random(0)
+ZOBRIST: List[int] = []
+
+def zobrist_table(n_cells: int) -> List[int]:
+    while len(ZOBRIST) < n_cells:
+        ZOBRIST.append(_zobrist_rng.getrandbits(64))
+    return ZOBRIST[:n_cells]
 
 def zobrist_hash(visited_mask: int) -> int:
+    zobrist_table(visited_mask.bit_length())
     h = 0
-    for y in range(7):
-        for x in range(7):
-            if visited_mask & (1 << (y * 7 + x)):
-                h ^= ZOBRIST[y][x]
+    i = 0
+    while visited_mask:
+        if visited_mask & 1:
+            h ^= ZOBRIST[i]
+        visited_mask >>= 1
+        i += 1
     return h
 
 class CellType(Enum):
@@ -33,18 +54,40 @@ class Cell:
         self.boss_index = boss_index
 
 class State:
-    def __init__(self, x, y, attack, lock_color, boss_hp, visited, path, boss_killed):
+    def __init__(self, x, y, attack, lock_color, boss_mask, visited, trail, length, pos, zhash=None):
         self.x = x
         self.y = y
+        # コンパイル済み盤面上のセル番号 (y * width + x)
+        self.pos = pos
         self.attack = attack
         self.lock_color = lock_color
-        self.boss_hp = boss_hp
+        # 倒したボスの boss_index をビットで持つ（ボスは生存/撃破の 2 状態しかない）
+        self.boss_mask = boss_mask
         self.visited = visited
-        self.path = path
-        self.boss_killed = boss_killed
+        # 経路は (x, y, 親 trail) の連結リストで子同士が共有する。list は path で必要時のみ復元
+        self.trail = trail
+        self.length = length
+        # visited の Zobrist ハッシュ。try_move で 1 回の XOR だけで更新する
+        self.zhash = zobrist_hash(visited) if zhash is None else zhash
+
+    @property
+    def boss_killed(self) -> int:
+        return self.boss_mask.bit_count()
 
-def bit(x, y):
-    return 1 << (y * 7 + x)
+    @property
+    def path(self) -> List[Tuple[int, int]]:
+        return trail_to_path(self.trail)
+
+def trail_to_path(trail) -> List[Tuple[int, int]]:
+    path = []
+    while trail is not None:
+        x, y, trail = trail
+        path.append((x, y))
+    path.reverse()
+    return path
+
+def bit(x, y, width=7):
+    return 1 << (y * width + x)
 
 directions = [
     (-1, -1), (0, -1), (1, -1),
@@ -52,8 +95,8 @@ directions = [
     (-1,  1), (0,  1), (1,  1)
 ]
 
-def valid(x, y):
-    return 0 <= x < 7 and 0 <= y < 7
+def valid(x, y, width=7, height=7):
+    return 0 <= x < width and 0 <= y < height
 
 def parse_cell(s: str, boss_counter: List[int]) -> Cell:
     if s == "P":
@@ -75,67 +118,163 @@ def parse_cell(s: str, boss_counter: List[int]) -> Cell:
         return Cell(CellType.OBSTACLE, None, 0)
     return Cell(CellType.EMPTY, None, 0)
 
-def try_move(state: State, cell: Cell, nx: int, ny: int) -> Optional[State]:
-    if state.visited & bit(nx, ny):
+def parse_board(rows) -> List[List[Cell]]:
+    boss_counter = [0]
+    return [[parse_cell(s if s else "", boss_counter) for s in row] for row in rows]
+
+def board_from_rows(text_rows: List[str]) -> List[List[Cell]]:
+    # "R . B5 X" のような空白（またはカンマ）区切りの行。"." は空マス
+    return parse_board([[("" if t == "." else t) for t in row.replace(",", " ").split()] for row in text_rows])
+
+# --------------------
+# 盤面コンパイル: Cell/Enum の 2 次元リストを整数テーブルに変換する
+# --------------------
+T_EMPTY = CellType.EMPTY.value
+T_OBSTACLE = CellType.OBSTACLE.value
+T_PLAYER = CellType.PLAYER.value
+T_ZAKO = CellType.ZAKO.value
+T_TREASURE = CellType.TREASURE.value
+T_BOSS = CellType.BOSS.value
+T_CRYSTAL = CellType.CRYSTAL.value
+
+COLOR_IDS = {"R": 0, "G": 1, "B": 2, "Y": 3}
+NO_COLOR = -1
+
+class CompiledBoard:
+    def __init__(self, width, height, ctype, color, hp, boss, neighbors, neighbor_mask, coords, zobrist, start, boss_hp):
+        self.width = width
+        self.height = height
+        self.ctype = ctype
+        self.color = color
+        self.hp = hp
+        self.boss = boss
+        self.neighbors = neighbors
+        self.neighbor_mask = neighbor_mask
+        self.coords = coords
+        self.zobrist = zobrist
+        self.start = start
+        self.boss_hp = boss_hp
+        # 上界計算（ビットボード flood fill）用のマスク
+        self.open_mask = 0
+        for i, t in enumerate(ctype):
+            if t != T_OBSTACLE:
+                self.open_mask |= 1 << i
+        col0 = 0
+        for y in range(height):
+            col0 |= 1 << (y * width)
+        self.not_first_col = ((1 << (width * height)) - 1) & ~col0
+        self.not_last_col = self.not_first_col >> 1
+        self.boss_cells = [0] * len(boss_hp)
+        for i, b in enumerate(boss):
+            if b >= 0:
+                self.boss_cells[b] = i
+
+def compile_board(board) -> CompiledBoard:
+    height = len(board)
+    width = len(board[0]) if height else 0
+    n_cells = width * height
+    ctype = [T_EMPTY] * n_cells
+    color = [NO_COLOR] * n_cells
+    hp = [0] * n_cells
+    boss = [-1] * n_cells
+    coords = [(i % width, i // width) for i in range(n_cells)]
+    zobrist = zobrist_table(n_cells)
+    start = None
+    boss_hp = []
+    for y in range(height):
+        for x in range(width):
+            cell = board[y][x]
+            i = y * width + x
+            ctype[i] = cell.type.value
+            color[i] = COLOR_IDS.get(cell.color, NO_COLOR)
+            hp[i] = cell.hp
+            if cell.type == CellType.BOSS:
+                boss[i] = cell.boss_index
+                boss_hp.append(cell.hp)
+            if cell.type == CellType.PLAYER:
+                start = i
+    if start is None:
+        raise ValueError("盤面にプレイヤー (P) がありません")
+
+    # 障害物と盤外は最初から除外しておき、探索中は表引きだけで済ませる
+    neighbors = []
+    neighbor_mask = []
+    for x, y in coords:
+        ns = []
+        for dx, dy in directions:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < width and 0 <= ny < height and ctype[ny * width + nx] != T_OBSTACLE:
+                ns.append(ny * width + nx)
+        neighbors.append(tuple(ns))
+        m = 0
+        for n in ns:
+            m |= 1 << n
+        neighbor_mask.append(m)
+
+    return CompiledBoard(width, height, ctype, color, hp, boss, neighbors, neighbor_mask, coords, zobrist, start, tuple(boss_hp))
+
+def try_move(state: State, cb: CompiledBoard, n: int) -> Optional[State]:
+    if state.visited & (1 << n):
         return None
 
     attack = state.attack
     lock = state.lock_color
-    boss_hp = list(state.boss_hp)
-    boss_killed = state.boss_killed
+    boss_mask = state.boss_mask
+    t = cb.ctype[n]
 
-    if cell.type == CellType.OBSTACLE:
+    if t == T_OBSTACLE:
         return None
 
-    elif cell.type == CellType.EMPTY:
+    elif t == T_EMPTY:
         attack += 1
 
-    elif cell.type == CellType.ZAKO:
-        color = cell.color
-        if lock is None:
+    elif t == T_ZAKO:
+        color = cb.color[n]
+        if lock == NO_COLOR:
             lock = color
         elif lock != color:
             return None
         attack += 1
 
-    elif cell.type == CellType.TREASURE:
-        color = cell.color
-        if lock is None:
+    elif t == T_TREASURE:
+        color = cb.color[n]
+        if lock == NO_COLOR:
             lock = color
         elif lock != color:
             return None
-        if attack < cell.hp:
+        if attack < cb.hp[n]:
             return None
-        attack = attack - cell.hp + 1
+        attack = attack - cb.hp[n] + 1
 
-    elif cell.type == CellType.BOSS:
-        if attack < cell.hp:
+    elif t == T_BOSS:
+        if attack < cb.hp[n]:
             return None
-        attack = attack - cell.hp + 1
-        lock = None
-        idx = cell.boss_index
-        if boss_hp[idx] > 0:
-            boss_hp[idx] = 0
-            boss_killed += 1
-
-    elif cell.type == CellType.CRYSTAL:
-        attack += 1
-        lock = None
+        attack = attack - cb.hp[n] + 1
+        lock = NO_COLOR
+        boss_mask |= 1 << cb.boss[n]
 
-    new_visited = state.visited | bit(nx, ny)
+    elif t == T_CRYSTAL:
+        attack += 1
+        lock = NO_COLOR
 
+    nx, ny = cb.coords[n]
     return State(
         x=nx,
         y=ny,
         attack=attack,
         lock_color=lock,
-        boss_hp=tuple(boss_hp),
-        visited=new_visited,
-        path=state.path + [(nx, ny)],
-        boss_killed=boss_killed
+        boss_mask=boss_mask,
+        visited=state.visited | (1 << n),
+        trail=(nx, ny, state.trail),
+        length=state.length + 1,
+        zhash=state.zhash ^ cb.zobrist[n],
+        pos=n
     )
 
 def update_best(best: List[State], state: State):
+    if isinstance(best, BestPaths):
+        best.offer(state)
+        return
     if not best:
         best.append(state)
         return
@@ -144,130 +283,1307 @@ def update_best(best: List[State], state: State):
         best.clear()
         best.append(state)
     elif state.boss_killed == b.boss_killed:
-        if len(state.path) > len(b.path):
+        if state.length > b.length:
             best.clear()
             best.append(state)
-        elif len(state.path) == len(b.path):
+        elif state.length == b.length:
             best.append(state)
 
+# 同点の最適経路はこの数だけ残す（画面に出すのは先頭の数本）
+BEST_K = 100
+
+def lock_switches(cb: CompiledBoard, state: State) -> int:
+    """経路中で色ロックがかかった回数（無色の状態から色つきマスを踏んだ回数）。"""
+    cells = []
+    trail = state.trail
+    while trail is not None:
+        x, y, trail = trail
+        cells.append(y * cb.width + x)
+    switches = 0
+    lock = NO_COLOR
+    for n in reversed(cells):
+        t = cb.ctype[n]
+        if t == T_ZAKO or t == T_TREASURE:
+            if lock == NO_COLOR:
+                switches += 1
+            lock = cb.color[n]
+        elif t == T_BOSS or t == T_CRYSTAL:
+            lock = NO_COLOR
+    return switches
+
+class BestPaths(list):
+    """(ボス数, 経路長) が最良の経路を上位 k 本だけ持つ best。
+    同点どうしは最終攻撃力が高い順、次に色ロックの回数が少ない順に並べる。
+    total は最良スコアに到達した回数で、k を超えた分も数える。正確な経路数になるのは置換表を使わない
+    全探索（nomemo）を最後まで回したときだけで、置換表のある探索では合流した経路は 1 回にまとまり、
+    探索の段階をまたいで同じ経路を 2 回数えることもある（simulate_board の optimal_paths_exact を見る）。"""
+
+    def __init__(self, k: int, cb: CompiledBoard):
+        super().__init__()
+        self.k = k
+        self.cb = cb
+        self.key = -1
+        self.total = 0
+        self.ranks = []
+        # 同じ経路を二重に持たないよう (pos, visited) ごとの保持数を数えておく
+        self._ends = {}
+        self._tie = itertools.count()
+
+    def offer(self, state: State):
+        key = score_key(state.boss_killed, state.length)
+        if key < self.key:
+            return
+        if key > self.key:
+            self.clear()
+            self.ranks.clear()
+            self._ends.clear()
+            self.key = key
+            self.total = 0
+        end = (state.pos, state.visited)
+        if end in self._ends and any(kept.trail == state.trail for kept in self if kept.visited == state.visited):
+            return
+        self.total += 1
+        full = len(self) >= self.k
+        # 攻撃力だけで入らないと決まるものは経路をたどらない
+        if full and -state.attack > self.ranks[-1][0]:
+            return
+        rank = (-state.attack, lock_switches(self.cb, state), next(self._tie))
+        if full and rank > self.ranks[-1]:
+            return
+        i = bisect.bisect(self.ranks, rank)
+        self.ranks.insert(i, rank)
+        self.insert(i, state)
+        self._ends[end] = self._ends.get(end, 0) + 1
+        if len(self) > self.k:
+            self.ranks.pop()
+            dropped = self.pop()
+            end = (dropped.pos, dropped.visited)
+            if self._ends[end] == 1:
+                del self._ends[end]
+            else:
+                self._ends[end] -= 1
+
+    def absorb(self, states: List[State], total: int):
+        """別の BestPaths（並列探索の部分木など）の中身と到達回数をまとめる。"""
+        if not states:
+            return
+        for st in states:
+            self.offer(st)
+        if score_key(states[0].boss_killed, states[0].length) == self.key:
+            self.total += total - len(states)
+
 def memo_key(state: State):
-    return (state.x, state.y, state.lock_color, state.boss_hp, zobrist_hash(state.visited))
+    return (state.pos, state.lock_color, state.boss_mask, state.zhash)
+
+def memo_key_full(state: State):
+    # ベンチマーク比較用: visited から毎回ハッシュを計算し直す旧方式
+    return (state.pos, state.lock_color, state.boss_mask, zobrist_hash(state.visited))
+
+# --------------------
+# 分枝限定: 残りで倒せるボス数と経路長の上界
+# --------------------
+def reachable_mask(cb: CompiledBoard, pos: int, visited: int) -> int:
+    # 未訪問・非障害物マスを 8 近傍で塗りつぶす。色ロックは無視するので上界になる
+    free = cb.open_mask & ~visited
+    # 隣の空きマスから塗り始める。行き止まり（葉の手前）はここで 0 を返してシフトを回さない
+    region = cb.neighbor_mask[pos] & free
+    if not region:
+        return 0
+    w = cb.width
+    while True:
+        h = region | ((region >> 1) & cb.not_last_col) | ((region << 1) & cb.not_first_col)
+        grown = ((h | (h << w) | (h >> w)) & free) | region
+        if grown == region:
+            return region
+        region = grown
+
+def upper_bound(state: State, cb: CompiledBoard, reach=None) -> Tuple[int, int]:
+    if reach is None:
+        reach = reachable_mask(cb, state.pos, state.visited)
+    n_reach = reach.bit_count()
+    # 攻撃力は 1 歩で高々 +1。ボスのマスに入る直前までに n_reach - 1 歩しか使えない
+    cap = state.attack + n_reach - 1
+    bosses = state.boss_killed
+    for idx, cell in enumerate(cb.boss_cells):
+        if not (state.boss_mask >> idx) & 1 and (reach >> cell) & 1 and cb.boss_hp[idx] <= cap:
+            bosses += 1
+    return bosses, state.length + n_reach
+
+def score_key(bosses: int, length: int) -> int:
+    # (ボス数, 経路長) の辞書式順序を 1 つの整数にまとめる（プロセス間共有用）
+    return (bosses << 16) | length
+
+def cannot_improve(state: State, cb: CompiledBoard, best: List[State], floor: int = 0, reach=None) -> bool:
+    target = floor
+    if best:
+        target = max(target, score_key(best[0].boss_killed, best[0].length))
+    if target == 0:
+        return False
+    boss_ub, length_ub = upper_bound(state, cb, reach)
+    # 同点（ボス数・経路長とも等しい）の経路は best に残したいので等号では切らない
+    return score_key(boss_ub, length_ub) < target
+
+# 時間切れの判定は毎ノードではなくこの間隔で行う
+DEADLINE_CHECK_INTERVAL = 1024
+
+# --------------------
+# 計測: 探索関数は counters に以下を足し込む
+#   expanded 展開した局面 / generated 作った子局面 / bound_pruned 上界で切った局面
+#   memo_dominated 置換表に同等以上の局面があって捨てた局面
+#   pareto_dominated 支配索引（DominanceIndex）に支配されて捨てた局面
+#   pruned_visited / pruned_lock / pruned_hp 訪問済み・色ロック違い・攻撃力不足で進めなかった手
+#   max_stack DFS のスタック（ビームでは層）の最大長
+# --------------------
+# on_sample を呼ぶ間隔（展開ノード数）の既定値
+SAMPLE_EVERY = 10000
+
+def blocked_by_lock(state: State, cb: CompiledBoard, n: int) -> bool:
+    # try_move が None を返した未訪問マスについて、原因が色ロックか（そうでなければ攻撃力不足）
+    t = cb.ctype[n]
+    return (t == T_ZAKO or t == T_TREASURE) and state.lock_color != NO_COLOR and state.lock_color != cb.color[n]
+
+def add_counts(counters: dict, max_stack=0, **counts):
+    for k, v in counts.items():
+        counters[k] = counters.get(k, 0) + v
+    counters["max_stack"] = max(counters.get("max_stack", 0), max_stack)
+
+def sample_counts(t0: float, best, **counts) -> dict:
+    # on_sample に渡す途中経過
+    elapsed = time.perf_counter() - t0
+    counts["elapsed_ms"] = int(elapsed * 1000)
+    counts["nodes_per_sec"] = int(counts.get("expanded", 0) / elapsed) if elapsed > 0 else 0
+    counts["best_bosses"] = best[0].boss_killed if best else 0
+    counts["best_length"] = best[0].length if best else 0
+    return counts
+
+def peak_rss_mb() -> Optional[float]:
+    # プロセス全体の最大常駐メモリ。resource が無い環境（Windows）では None
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS は byte 単位
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
 
-def dfs_with_memo(state: State, board, best, memo, max_steps=200000):
+def search_stats(counters: dict, elapsed_s: float) -> dict:
+    """counters を stats 用の名前にまとめる。"""
+    expanded = counters.get("expanded", 0)
+    return {
+        "nodes_visited": expanded,
+        "nodes_generated": counters.get("generated", 0),
+        "bound_pruned": counters.get("bound_pruned", 0),
+        "memo_dominated": counters.get("memo_dominated", 0),
+        "pareto_dominated": counters.get("pareto_dominated", 0),
+        "pruned_visited": counters.get("pruned_visited", 0),
+        "pruned_lock": counters.get("pruned_lock", 0),
+        "pruned_hp": counters.get("pruned_hp", 0),
+        "max_stack_depth": counters.get("max_stack", 0),
+        "nodes_per_sec": int(expanded / elapsed_s) if elapsed_s > 0 else 0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+# --------------------
+# 置換表: (pos, lock, ボス, visited ハッシュ) -> その局面で見た最大攻撃力
+# --------------------
+# 1 エントリあたりの概算メモリ（キーのタプル + 64bit ハッシュ int + スロット参照）
+TT_ENTRY_BYTES = 160
+
+class TranspositionTable:
+    """size_mb=None なら dict による無制限の表。指定した場合は固定容量の 2-way の表になる。
+    各バケットの片方は根に近い（経路が短い）局面を優先して残し、もう片方は常に上書きする。
+    track_visited=True のときは各エントリの visited も持ち、盤面編集後に invalidate できる。"""
+
+    def __init__(self, size_mb=None, track_visited=False):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.track_visited = track_visited
+        if size_mb is None:
+            self.capacity = None
+            self.table = {}
+            self.visited_of = {}
+            return
+        slots = max(2, int(size_mb * 1024 * 1024) // TT_ENTRY_BYTES)
+        self.capacity = 1 << (slots.bit_length() - 1)
+        self.mask = self.capacity - 2
+        self.keys = [None] * self.capacity
+        self.attacks = [0] * self.capacity
+        self.depths = [0] * self.capacity
+        self.visiteds = [0] * self.capacity
+        self.count = 0
+
+    def get(self, key) -> Optional[int]:
+        if self.capacity is None:
+            v = self.table.get(key)
+        else:
+            i = hash(key) & self.mask
+            keys = self.keys
+            if keys[i] == key:
+                v = self.attacks[i]
+            elif keys[i + 1] == key:
+                v = self.attacks[i + 1]
+            else:
+                v = None
+        if v is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return v
+
+    def store(self, key, attack: int, depth: int, visited: int = 0):
+        if self.capacity is None:
+            self.table[key] = attack
+            if self.track_visited:
+                self.visited_of[key] = visited
+            return
+        i = hash(key) & self.mask
+        keys = self.keys
+        if keys[i] == key:
+            self.attacks[i] = attack
+            return
+        if keys[i + 1] == key:
+            self.attacks[i + 1] = attack
+            return
+        if keys[i] is None or depth <= self.depths[i]:
+            # 浅い局面は優先スロットへ。元の住人は常時上書きスロットへ移す
+            if keys[i] is not None:
+                self._put(i + 1, keys[i], self.attacks[i], self.depths[i], self.visiteds[i])
+            else:
+                self.count += 1
+            keys[i] = key
+            self.attacks[i] = attack
+            self.depths[i] = depth
+            self.visiteds[i] = visited
+        else:
+            self._put(i + 1, key, attack, depth, visited)
+
+    def _put(self, i, key, attack, depth, visited):
+        if self.keys[i] is None:
+            self.count += 1
+        else:
+            self.evictions += 1
+        self.keys[i] = key
+        self.attacks[i] = attack
+        self.depths[i] = depth
+        self.visiteds[i] = visited
+
+    def invalidate(self, keep) -> int:
+        """keep(key, visited) が False のエントリを捨て、捨てた数を返す。track_visited=True が前提。"""
+        dropped = 0
+        if self.capacity is None:
+            for key in list(self.table):
+                if not keep(key, self.visited_of.get(key, 0)):
+                    del self.table[key]
+                    self.visited_of.pop(key, None)
+                    dropped += 1
+            return dropped
+        for i, key in enumerate(self.keys):
+            if key is not None and not keep(key, self.visiteds[i]):
+                self.keys[i] = None
+                self.count -= 1
+                dropped += 1
+        return dropped
+
+    def __len__(self):
+        return len(self.table) if self.capacity is None else self.count
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "tt_entries": len(self),
+            "tt_capacity": self.capacity if self.capacity is not None else -1,
+            "tt_hits": self.hits,
+            "tt_misses": self.misses,
+            "tt_hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "tt_evictions": self.evictions,
+        }
+
+# --------------------
+# 支配索引: (pos, lock, ボス) -> 展開済み局面 (visited, attack, length) の小さなパレート前線
+# --------------------
+# 1 キーあたりに残す局面数。溢れたら古いものから捨てる（捨てても枝刈りが減るだけ）
+DOMINANCE_FRONTIER = 8
+
+class DominanceIndex:
+    """置換表は visited が完全に一致する局面しか切れないので、位置・ロック色・倒したボスが同じ局面を
+    visited の包含関係で比べる。新しい局面 B は、記録済みの局面 A が
+      - 攻撃力・経路長とも B 以上で
+      - A の visited が B からまだ辿れるマス（reach）と交わらない
+    とき捨てる。B から先の経路はどれも A からそのまま辿れ、攻撃力は増減が同じなので A 以上、
+    スコアも A 以上になるので最良スコアは変わらない（置換表と同じく、同点の経路は数が減ることがある）。
+    経路長は長いほど良いので、単純な visited の包含（A ⊆ B なら A の方が短い）ではなく reach の上だけで比べる。"""
+
+    def __init__(self, frontier=DOMINANCE_FRONTIER):
+        self.frontier = frontier
+        self.table = {}
+
+    def __len__(self):
+        return sum(len(v) for v in self.table.values())
+
+    def check(self, state: State, reach: int) -> bool:
+        """state が記録済みの局面に支配されていれば True。そうでなければ state を記録して False を返す。
+        判定と記録で表を 1 回しか引かず、記録の一覧も 1 回しか走査しない。"""
+        key = (state.pos, state.lock_color, state.boss_mask)
+        visited = state.visited
+        attack = state.attack
+        length = state.length
+        entries = self.table.get(key)
+        if entries is None:
+            self.table[key] = [(visited, attack, length)]
+            return False
+        same = -1
+        for i, (v, a, l) in enumerate(entries):
+            if a >= attack and l >= length and not v & reach:
+                return True
+            if v == visited:
+                same = i
+        # 新しい局面が支配する（攻撃力・経路長が以上で visited が部分集合の）記録は、それで切れる局面を
+        # 新しい局面でも必ず切れるので外す。経路長は visited のマス数なので、そうなるのは visited が同じで
+        # 攻撃力が低い記録だけ（攻撃力が以上なら上で支配されている）。1 つのキーに同じ visited は 1 つしか残らない
+        if same >= 0:
+            del entries[same]
+        entries.append((visited, attack, length))
+        if len(entries) > self.frontier:
+            del entries[0]
+        return False
+
+def dfs_with_memo(state: State, cb: CompiledBoard, best, memo: TranspositionTable, max_steps=200000, key_fn=memo_key, counters=None, prune=True, deadline=None, shared=None, progress=None, on_sample=None, sample_every=SAMPLE_EVERY, dominance=False):
+    """探索し尽くした（best が最適と証明された）とき True を返す。
+    dominance=True なら置換表に加えて DominanceIndex でも支配された局面を捨てる。展開数は 3〜5 割減るが、
+    6x5 の盤面では索引を引く分で相殺されて速くならなかったので既定では使わない。
+    shared を渡すと他プロセスと best のスコアを共有し、互いの枝刈りに使う。
+    progress（SolveProgress）を渡すと途中経過を報告し、キャンセルされたら打ち切る。
+    on_sample を渡すと約 sample_every ノード展開するごとに途中の計数を渡して呼ぶ。"""
+    neighbors = cb.neighbors
+    index = DominanceIndex() if dominance else None
+    bound_pruned = 0
+    expanded = 0
+    generated = 0
+    memo_dominated = 0
+    pareto_dominated = 0
+    pruned_visited = 0
+    pruned_lock = 0
+    pruned_hp = 0
+    max_stack = 1
+    reported = 0
+    next_sample = sample_every
+    t0 = time.perf_counter()
+    floor = 0
+    cut = False
     stack = [state]
     steps = 0
     while stack:
-        cur = stack.pop()
         steps += 1
         if steps > max_steps:
+            cut = True
             break
-        key = memo_key(cur)
-        prev = memo.get(key)
-        if prev is not None:
-            prev_attack, prev_boss_killed = prev
-            if prev_attack >= cur.attack and prev_boss_killed >= cur.boss_killed:
-                continue
-        memo[key] = (cur.attack, cur.boss_killed)
+        if steps % DEADLINE_CHECK_INTERVAL == 0:
+            if deadline is not None and time.perf_counter() >= deadline:
+                cut = True
+                break
+            if shared is not None:
+                if best:
+                    shared.offer(score_key(best[0].boss_killed, best[0].length))
+                floor = shared.get()
+            if progress is not None:
+                progress.report(expanded - reported, best)
+                reported = expanded
+                if progress.cancelled:
+                    cut = True
+                    break
+            if on_sample is not None and expanded >= next_sample:
+                next_sample = expanded + sample_every
+                on_sample(sample_counts(t0, best, expanded=expanded, generated=generated, bound_pruned=bound_pruned,
+                                        memo_dominated=memo_dominated, pareto_dominated=pareto_dominated, pruned_visited=pruned_visited,
+                                        pruned_lock=pruned_lock, pruned_hp=pruned_hp, stack=len(stack)))
+        cur = stack.pop()
+        key = key_fn(cur)
+        prev_attack = memo.get(key)
+        if prev_attack is not None and prev_attack >= cur.attack:
+            memo_dominated += 1
+            continue
+        memo.store(key, cur.attack, cur.length, cur.visited)
+        reach = reachable_mask(cb, cur.pos, cur.visited) if (prune or index is not None) else None
+        if index is not None and index.check(cur, reach):
+            pareto_dominated += 1
+            continue
+        expanded += 1
         update_best(best, cur)
-        for dx, dy in directions:
-            nx, ny = cur.x + dx, cur.y + dy
-            if not valid(nx, ny):
+        if prune and cannot_improve(cur, cb, best, floor, reach):
+            bound_pruned += 1
+            continue
+        visited = cur.visited
+        for n in neighbors[cur.pos]:
+            if visited & (1 << n):
+                pruned_visited += 1
                 continue
-            cell = board[ny][nx]
-            next_state = try_move(cur, cell, nx, ny)
+            next_state = try_move(cur, cb, n)
             if next_state is None:
+                if blocked_by_lock(cur, cb, n):
+                    pruned_lock += 1
+                else:
+                    pruned_hp += 1
                 continue
+            generated += 1
             stack.append(next_state)
+        if len(stack) > max_stack:
+            max_stack = len(stack)
+    if counters is not None:
+        add_counts(counters, max_stack=max_stack, bound_pruned=bound_pruned, expanded=expanded, generated=generated,
+                   memo_dominated=memo_dominated, pareto_dominated=pareto_dominated, pruned_visited=pruned_visited, pruned_lock=pruned_lock, pruned_hp=pruned_hp)
+    if shared is not None and best:
+        shared.offer(score_key(best[0].boss_killed, best[0].length))
+    if progress is not None:
+        progress.report(expanded - reported, best)
+    return not cut
 
-def dfs_no_memo(state: State, board, best, counters, max_steps=500000):
-    if counters["nodes"] >= max_steps:
-        return
-    counters["nodes"] += 1
-    update_best(best, state)
-    for dx, dy in directions:
-        nx, ny = state.x + dx, state.y + dy
-        if not valid(nx, ny):
-            continue
-        cell = board[ny][nx]
-        next_state = try_move(state, cell, nx, ny)
-        if next_state is None:
-            continue
-        dfs_no_memo(next_state, board, best, counters, max_steps)
+def move_priority(cur: State, child: State) -> int:
+    """手の並べ替え用（小さいほど先に探索）。
+    0: 今ボスを倒せる手 / 1: 色ロックが空いたまま（または解除される）手 / 2: 今のロック色のまま / 3: 新たにロックする手"""
+    if child.boss_mask != cur.boss_mask:
+        return 0
+    if child.lock_color == NO_COLOR:
+        return 1
+    if child.lock_color == cur.lock_color:
+        return 2
+    return 3
 
-def beam_search(initial: State, board, beam_width=200, max_steps=200000):
-    pq = [(-initial.boss_killed, -len(initial.path), -initial.attack, initial)]
-    memo = {}
-    best = []
+def dfs_no_memo(state: State, cb: CompiledBoard, best, counters, max_steps=500000, deadline=None, on_sample=None, sample_every=SAMPLE_EVERY):
+    """明示スタックによる全探索。良さそうな手から展開するので、max_steps や締め切りで
+    打ち切っても良い暫定解が残りやすい。打ち切ったときは counters["cut"] を立てる。"""
+    neighbors = cb.neighbors
+    nodes = counters["nodes"]
+    generated = 0
+    pruned_visited = 0
+    pruned_lock = 0
+    pruned_hp = 0
+    max_stack = 1
+    next_sample = nodes + sample_every
+    t0 = time.perf_counter()
+    stack = [state]
+    while stack:
+        if nodes >= max_steps:
+            counters["cut"] = True
+            break
+        if nodes % DEADLINE_CHECK_INTERVAL == 0:
+            if deadline is not None and time.perf_counter() >= deadline:
+                counters["cut"] = True
+                break
+            if on_sample is not None and nodes >= next_sample:
+                next_sample = nodes + sample_every
+                on_sample(sample_counts(t0, best, expanded=nodes, generated=generated, pruned_visited=pruned_visited,
+                                        pruned_lock=pruned_lock, pruned_hp=pruned_hp, stack=len(stack)))
+        cur = stack.pop()
+        nodes += 1
+        update_best(best, cur)
+        buckets = ([], [], [], [])
+        visited = cur.visited
+        for n in neighbors[cur.pos]:
+            if visited & (1 << n):
+                pruned_visited += 1
+                continue
+            next_state = try_move(cur, cb, n)
+            if next_state is None:
+                if blocked_by_lock(cur, cb, n):
+                    pruned_lock += 1
+                else:
+                    pruned_hp += 1
+                continue
+            buckets[move_priority(cur, next_state)].append(next_state)
+        # スタックは後入れ先出しなので、優先度の低い手から積む
+        stack.extend(buckets[3])
+        stack.extend(buckets[2])
+        stack.extend(buckets[1])
+        stack.extend(buckets[0])
+        generated += len(buckets[0]) + len(buckets[1]) + len(buckets[2]) + len(buckets[3])
+        if len(stack) > max_stack:
+            max_stack = len(stack)
+    add_counts(counters, max_stack=max_stack, expanded=nodes - counters["nodes"], generated=generated,
+               pruned_visited=pruned_visited, pruned_lock=pruned_lock, pruned_hp=pruned_hp)
+    counters["nodes"] = nodes
+
+def select_diverse(ranked, beam_width: int, region_of, region_share: float):
+    """優先度順の候補から beam_width 個を選ぶ。1 回目は領域ごとに beam_width * region_share 個まで、
+    残りの枠は 2 回目に優先度順で埋める（枠を余らせない）。"""
+    if len(ranked) <= beam_width:
+        return [c[-1] for c in ranked]
+    quota = max(1, int(beam_width * region_share))
+    taken = {}
+    chosen = []
+    rest = []
+    for c in ranked:
+        state = c[-1]
+        r = region_of[state.pos]
+        if len(chosen) < beam_width and taken.get(r, 0) < quota:
+            taken[r] = taken.get(r, 0) + 1
+            chosen.append(state)
+        else:
+            rest.append(state)
+    for state in rest:
+        if len(chosen) >= beam_width:
+            break
+        chosen.append(state)
+    return chosen
+
+def beam_search(initial: State, cb: CompiledBoard, beam_width=200, max_steps=200000, key_fn=memo_key, deadline=None, memo=None, regions=3, region_share=0.25, progress=None, top_k=BEST_K, counters=None, on_sample=None, sample_every=SAMPLE_EVERY):
+    """層ごとのビーム探索。同じ層の (位置, 倒したボス, ロック色) が同じ状態は最良の 1 つにまとめ、
+    盤面を regions x regions の領域に分けて 1 領域がビームを独占しないようにする。"""
+    neighbors = cb.neighbors
+    region_of = [(y * regions // cb.height) * regions + (x * regions // cb.width) for x, y in cb.coords]
+    # 優先度が同じときに State 同士の比較にならないよう通し番号を挟む
+    tie = itertools.count()
+    memo = TranspositionTable() if memo is None else memo
+    best = BestPaths(top_k, cb)
+    expanded = 0
+    generated = 0
+    memo_dominated = 0
+    pruned_visited = 0
+    pruned_lock = 0
+    pruned_hp = 0
+    max_stack = 1
+    next_sample = sample_every
+    t0 = time.perf_counter()
+    layer = [initial]
     steps = 0
-    while pq and steps < max_steps:
-        layer = []
-        for _ in range(min(len(pq), beam_width)):
-            layer.append(heapq.heappop(pq))
-        next_candidates = []
-        for _, _, _, state in layer:
+    while layer and steps < max_steps:
+        if deadline is not None and time.perf_counter() >= deadline:
+            break
+        if progress is not None and progress.cancelled:
+            break
+        if on_sample is not None and expanded >= next_sample:
+            next_sample = expanded + sample_every
+            on_sample(sample_counts(t0, best, expanded=expanded, generated=generated, memo_dominated=memo_dominated,
+                                    pruned_visited=pruned_visited, pruned_lock=pruned_lock, pruned_hp=pruned_hp, stack=len(layer)))
+        candidates = {}
+        for state in layer:
             update_best(best, state)
-            for dx, dy in directions:
-                nx, ny = state.x + dx, state.y + dy
-                if not valid(nx, ny):
+            expanded += 1
+            visited = state.visited
+            for n in neighbors[state.pos]:
+                if visited & (1 << n):
+                    pruned_visited += 1
                     continue
-                cell = board[ny][nx]
-                next_state = try_move(state, cell, nx, ny)
+                next_state = try_move(state, cb, n)
                 if next_state is None:
+                    if blocked_by_lock(state, cb, n):
+                        pruned_lock += 1
+                    else:
+                        pruned_hp += 1
                     continue
-                key = memo_key(next_state)
-                prev = memo.get(key)
-                if prev is not None:
-                    prev_attack, prev_boss_killed = prev
-                    if prev_attack >= next_state.attack and prev_boss_killed >= next_state.boss_killed:
-                        continue
-                memo[key] = (next_state.attack, next_state.boss_killed)
-                heapq.heappush(next_candidates, (-next_state.boss_killed, -len(next_state.path), -next_state.attack, next_state))
+                generated += 1
+                key = key_fn(next_state)
+                prev_attack = memo.get(key)
+                if prev_attack is not None and prev_attack >= next_state.attack:
+                    memo_dominated += 1
+                    continue
+                memo.store(key, next_state.attack, next_state.length, next_state.visited)
                 steps += 1
+                entry = (-next_state.boss_killed, -next_state.length, -next_state.attack, next(tie), next_state)
+                dedup = (next_state.pos, next_state.boss_mask, next_state.lock_color)
+                prev = candidates.get(dedup)
+                if prev is None or entry < prev:
+                    candidates[dedup] = entry
                 if steps >= max_steps:
                     break
             if steps >= max_steps:
                 break
-        pq = heapq.nsmallest(beam_width, next_candidates)
+        # ビームでは「スタック」の代わりに絞り込む前の層の候補数を見る
+        if len(candidates) > max_stack:
+            max_stack = len(candidates)
+        layer = select_diverse(sorted(candidates.values()), beam_width, region_of, region_share)
+    for state in layer:
+        update_best(best, state)
+    if counters is not None:
+        add_counts(counters, max_stack=max_stack, expanded=expanded, generated=generated, memo_dominated=memo_dominated,
+                   pruned_visited=pruned_visited, pruned_lock=pruned_lock, pruned_hp=pruned_hp)
     return best
 
-def simulate_board(board, mode="memo", max_steps=200000, beam_width=300):
-    start_x = start_y = None
-    boss_hp = []
-    for y in range(7):
-        for x in range(7):
-            cell = board[y][x]
-            if cell.type == CellType.BOSS:
-                boss_hp.append(cell.hp)
-            if cell.type == CellType.PLAYER:
-                start_x, start_y = x, y
-
-    initial = State(
+def initial_state(cb: CompiledBoard) -> State:
+    start_x, start_y = cb.coords[cb.start]
+    return State(
         x=start_x,
         y=start_y,
         attack=0,
-        lock_color=None,
-        boss_hp=tuple(boss_hp),
-        visited=bit(start_x, start_y),
-        path=[(start_x, start_y)],
-        boss_killed=0
+        lock_color=NO_COLOR,
+        boss_mask=0,
+        visited=1 << cb.start,
+        trail=(start_x, start_y, None),
+        length=1,
+        pos=cb.start,
+        zhash=cb.zobrist[cb.start]
     )
 
-    best = []
-    stats = {"search_time_ms": 0, "nodes_visited": 0}
+def replay_path(cb: CompiledBoard, path) -> Optional[State]:
+    """path を盤面上で辿り直して State を作る。途中で動けなければ None。"""
+    if not path or tuple(path[0]) != cb.coords[cb.start]:
+        return None
+    state = initial_state(cb)
+    for x, y in path[1:]:
+        if not (0 <= x < cb.width and 0 <= y < cb.height):
+            return None
+        n = y * cb.width + x
+        if not (cb.neighbor_mask[state.pos] >> n) & 1:
+            return None
+        state = try_move(state, cb, n)
+        if state is None:
+            return None
+    return state
+
+def anytime_search(initial: State, cb: CompiledBoard, deadline, memo: TranspositionTable, max_steps=200000, beam_width=300, counters=None, seed=None, progress=None, top_k=BEST_K, on_sample=None, sample_every=SAMPLE_EVERY):
+    """時間予算つき探索。まず幅の狭いビームで暫定解を作り、それを上界の初期値にして
+    分枝限定 DFS を締め切りまで回す。seed があればその経路も暫定解に加える。
+    (best, 最適性が証明できたか) を返す。"""
+    best = BestPaths(top_k, cb)
+    for s in seed or ():
+        update_best(best, s)
+    for s in beam_search(initial, cb, beam_width=min(beam_width, 50), max_steps=max_steps, deadline=deadline, progress=progress,
+                         counters=counters, on_sample=on_sample, sample_every=sample_every):
+        update_best(best, s)
+    complete = dfs_with_memo(initial, cb, best, memo, max_steps=max_steps, counters=counters, deadline=deadline, progress=progress,
+                             on_sample=on_sample, sample_every=sample_every)
+    return best, complete
+
+# --------------------
+# 並列探索: 浅い深さで木を分割し、部分木をプロセスプールで解く
+# --------------------
+class SharedBound:
+    def __init__(self, value):
+        self.value = value
+
+    def get(self) -> int:
+        return self.value.value
+
+    def offer(self, key: int):
+        if key <= self.value.value:
+            return
+        with self.value.get_lock():
+            if key > self.value.value:
+                self.value.value = key
+
+_worker_shared = None
+
+def _init_worker(value):
+    global _worker_shared
+    _worker_shared = SharedBound(value)
+
+def _solve_subtree(cb: CompiledBoard, root: State, max_steps, wall_deadline, tt_size_mb, top_k):
+    # wall_deadline は time.time() 基準（perf_counter はプロセス間で比べられない）。
+    # 締め切り後に取り出されたタスクは何もせずに返す
+    best = BestPaths(top_k, cb)
+    deadline = None
+    if wall_deadline is not None:
+        remaining = wall_deadline - time.time()
+        if remaining <= 0:
+            return [], 0, False, {}
+        deadline = time.perf_counter() + remaining
+    memo = TranspositionTable(tt_size_mb)
+    counters = {}
+    complete = dfs_with_memo(root, cb, best, memo, max_steps=max_steps, counters=counters, deadline=deadline, shared=_worker_shared)
+    counters.update(memo.stats())
+    # 盤面ごと送り返さないよう、経路と到達回数に分けて返す
+    return list(best), best.total, complete, counters
+
+def split_frontier(initial: State, cb: CompiledBoard, depth: int, best: List[State]) -> List[State]:
+    # 深さ depth までは手元で展開する（途中の状態は best にも反映）
+    frontier = [initial]
+    for _ in range(depth):
+        children = []
+        for s in frontier:
+            update_best(best, s)
+            for n in cb.neighbors[s.pos]:
+                child = try_move(s, cb, n)
+                if child is not None:
+                    children.append(child)
+        frontier = children
+    return frontier
+
+def parallel_search(initial: State, cb: CompiledBoard, workers=None, split_depth=2, max_steps=200000, deadline=None, counters=None, tt_size_mb=None, top_k=BEST_K):
+    """ルート付近で分割した部分木を ProcessPoolExecutor で並列に解く。
+    max_steps は全体の上限として部分木に均等に割り振る。tt_size_mb は部分木（ワーカー内の表）ごとの容量。
+    (best, 最適性が証明できたか) を返す。"""
+    best = BestPaths(top_k, cb)
+    tasks = split_frontier(initial, cb, split_depth, best)
+    per_task_steps = max(DEADLINE_CHECK_INTERVAL, -(-max_steps // max(1, len(tasks))))
+    shared_value = multiprocessing.Value("q", 0)
+    if best:
+        shared_value.value = score_key(best[0].boss_killed, best[0].length)
+    complete = True
+    totals = {}
+    # 全タスクで 1 つの締め切りを共有する（後から取り出されたタスクにも予算が丸ごと付かないように）
+    wall_deadline = None if deadline is None else time.time() + (deadline - time.perf_counter())
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(shared_value,)) as pool:
+        pending = {pool.submit(_solve_subtree, cb, root, per_task_steps, wall_deadline, tt_size_mb, top_k) for root in tasks}
+        while pending:
+            timeout = None if wall_deadline is None else max(0.0, wall_deadline - time.time())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # 締め切りを過ぎた: まだ始まっていないタスクは取り消し、実行中のものは自分の締め切りで止まるのを待つ
+                for f in pending:
+                    if f.cancel():
+                        complete = False
+                pending = {f for f in pending if not f.cancelled()}
+                wall_deadline = None
+                continue
+            for f in done:
+                sub_best, sub_total, sub_complete, sub_counters = f.result()
+                best.absorb(sub_best, sub_total)
+                complete = complete and sub_complete
+                for k, v in sub_counters.items():
+                    if k == "max_stack":
+                        totals[k] = max(totals.get(k, 0), v)
+                    elif k != "tt_hit_rate":
+                        totals[k] = totals.get(k, 0) + v
+    if counters is not None:
+        counters.update(totals)
+        lookups = totals.get("tt_hits", 0) + totals.get("tt_misses", 0)
+        counters["tt_hit_rate"] = round(totals.get("tt_hits", 0) / lookups, 4) if lookups else 0.0
+        counters["tasks"] = len(tasks)
+    return best, complete
+
+# --------------------
+# モンテカルロ木探索 (UCT)
+# --------------------
+class MCTSNode:
+    __slots__ = ("state", "parent", "children", "untried", "visits", "value", "done")
+
+    def __init__(self, state: State, parent, cb: CompiledBoard):
+        self.state = state
+        self.parent = parent
+        self.children = []
+        # 合法手の子 State は作成時にまとめて作る（try_move を二度呼ばない）
+        self.untried = [c for c in (try_move(state, cb, n) for n in cb.neighbors[state.pos]) if c is not None]
+        self.visits = 0
+        self.value = 0.0
+        # 部分木を展開し尽くしたら True（選択の対象から外す）
+        self.done = not self.untried
+
+def _mark_done(node: MCTSNode):
+    while node is not None and not node.untried and all(ch.done for ch in node.children):
+        node.done = True
+        node = node.parent
+
+def _rollout(state: State, cb: CompiledBoard, rng: random.Random, greedy: bool, epsilon: float):
+    """終端まで 1 本の経路を進める。(終端の State, 生成した子の数) を返す。"""
+    generated = 0
+    neighbors = cb.neighbors
+    while True:
+        moves = [c for c in (try_move(state, cb, n) for n in neighbors[state.pos]) if c is not None]
+        generated += len(moves)
+        if not moves:
+            return state, generated
+        if greedy and rng.random() >= epsilon:
+            top = min(move_priority(state, c) for c in moves)
+            moves = [c for c in moves if move_priority(state, c) == top]
+        state = moves[rng.randrange(len(moves))]
+
+def mcts_search(initial: State, cb: CompiledBoard, max_steps=200000, deadline=None, rollout="greedy", exploration=1.4, epsilon=0.2, seed=0, counters=None, top_k=BEST_K):
+    """UCT による探索。rollout="greedy" は move_priority の良い手を（確率 epsilon でランダムに）選び、
+    "random" は一様ランダム。max_steps は生成した子 State の総数で数える。"""
+    rng = random.Random(seed)
+    greedy = rollout == "greedy"
+    n_cells = cb.width * cb.height
+    # 報酬は (ボス数, 経路長) の辞書式順序を保ったまま [0, 1] に正規化する
+    norm = (len(cb.boss_hp) + 1) * (n_cells + 1)
+    root = MCTSNode(initial, None, cb)
+    best = BestPaths(top_k, cb)
+    update_best(best, initial)
+    steps = len(root.untried)
+    iterations = 0
+    # 木を展開し尽くしたら（root.done）終了する
+    while steps < max_steps and not root.done:
+        if deadline is not None and iterations % 64 == 0 and time.perf_counter() >= deadline:
+            break
+        iterations += 1
+        node = root
+        while not node.untried:
+            log_n = math.log(node.visits)
+            node = max((ch for ch in node.children if not ch.done), key=lambda ch: ch.value / ch.visits + exploration * math.sqrt(log_n / ch.visits))
+        child_state = node.untried.pop(rng.randrange(len(node.untried)))
+        child = MCTSNode(child_state, node, cb)
+        steps += len(child.untried)
+        node.children.append(child)
+        node = child
+        if node.done:
+            _mark_done(node.parent)
+        final, generated = _rollout(node.state, cb, rng, greedy, epsilon)
+        steps += generated
+        update_best(best, final)
+        reward = (final.boss_killed * (n_cells + 1) + final.length) / norm
+        while node is not None:
+            node.visits += 1
+            node.value += reward
+            node = node.parent
+    if counters is not None:
+        counters["nodes"] = steps
+        counters["iterations"] = iterations
+        # 根まで done になっていれば木を全て展開し終えていて、best は最適
+        counters["done"] = root.done
+        add_counts(counters, expanded=iterations, generated=steps)
+    return best
+
+def simulate_board(board, mode="memo", max_steps=200000, beam_width=300, time_budget_ms=None, workers=None, split_depth=2, tt_size_mb=None, top_k=BEST_K,
+                   on_sample=None, sample_every=SAMPLE_EVERY, trace_memory=False):
+    """盤面を mode の探索で解き、(best, stats) を返す。
+    on_sample は nomemo / memo / beam で約 sample_every ノードごとに途中の計数を受け取る。
+    trace_memory=True なら tracemalloc で探索中のピークメモリを測る（その分遅くなる）。"""
+    cb = board if isinstance(board, CompiledBoard) else compile_board(board)
+    initial = initial_state(cb)
+    deadline = None if time_budget_ms is None else time.perf_counter() + time_budget_ms / 1000
+
+    best = BestPaths(top_k, cb)
+    stats = {}
+    counters = {}
+    if trace_memory:
+        tracemalloc.start()
     t0 = time.time()
 
     if mode == "nomemo":
-        counters = {"nodes": 0}
-        dfs_no_memo(initial, board, best, counters, max_steps=max_steps)
-        stats["nodes_visited"] = counters["nodes"]
+        counters["nodes"] = 0
+        dfs_no_memo(initial, cb, best, counters, max_steps=max_steps, deadline=deadline, on_sample=on_sample, sample_every=sample_every)
+        stats["proven_optimal"] = not counters.get("cut", False)
     elif mode == "beam":
-        best = beam_search(initial, board, beam_width=beam_width, max_steps=max_steps)
-        stats["nodes_visited"] = -1
+        memo = TranspositionTable(tt_size_mb)
+        best = beam_search(initial, cb, beam_width=beam_width, max_steps=max_steps, deadline=deadline, memo=memo, top_k=top_k,
+                           counters=counters, on_sample=on_sample, sample_every=sample_every)
+        stats["proven_optimal"] = False
+        stats.update(memo.stats())
+    elif mode == "mcts":
+        best = mcts_search(initial, cb, max_steps=max_steps, deadline=deadline, counters=counters, top_k=top_k)
+        stats["mcts_iterations"] = counters["iterations"]
+        stats["proven_optimal"] = counters["done"]
+    elif mode == "parallel":
+        best, complete = parallel_search(initial, cb, workers=workers, split_depth=split_depth, max_steps=max_steps, deadline=deadline, counters=counters, tt_size_mb=tt_size_mb, top_k=top_k)
+        stats["parallel_tasks"] = counters["tasks"]
+        stats["proven_optimal"] = complete
+        for k in ("tt_entries", "tt_hits", "tt_misses", "tt_hit_rate", "tt_evictions"):
+            stats[k] = counters.get(k, 0)
     else:
-        memo = {}
-        dfs_with_memo(initial, board, best, memo, max_steps=max_steps)
-        stats["nodes_visited"] = len(memo)
+        memo = TranspositionTable(tt_size_mb)
+        if deadline is not None:
+            best, complete = anytime_search(initial, cb, deadline, memo, max_steps=max_steps, beam_width=beam_width, counters=counters, top_k=top_k,
+                                            on_sample=on_sample, sample_every=sample_every)
+        else:
+            complete = dfs_with_memo(initial, cb, best, memo, max_steps=max_steps, counters=counters, on_sample=on_sample, sample_every=sample_every)
+        stats["proven_optimal"] = complete
+        stats.update(memo.stats())
 
-    t1 = time.time()
-    stats["search_time_ms"] = int((t1 - t0) * 1000)
+    elapsed = time.time() - t0
+    stats.update(search_stats(counters, elapsed))
+    if mode == "mcts":
+        # MCTS はロールアウトで作った局面も含めた生成数を訪問数とする（従来どおり）
+        stats["nodes_visited"] = counters["nodes"]
+    if trace_memory:
+        stats["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+        tracemalloc.stop()
+    stats["search_time_ms"] = int(elapsed * 1000)
+    stats["boss_mask"] = best[0].boss_mask if best else 0
+    stats["optimal_paths"] = best.total
+    stats["optimal_paths_exact"] = mode == "nomemo" and stats["proven_optimal"]
     return best, stats
+
+# --------------------
+# 盤面編集後の再探索（ウォームスタート）
+# --------------------
+# セッションに残す経路数（次回の検証と枝刈りの初期値に使う）
+WARM_MAX_PATHS = 50
+
+class SolveSession:
+    """前回の探索結果。置換表・best の経路・最適性が証明できたかを持ち越す。
+    置換表は最適と証明できたときしか次の探索で使わないので、証明できなかった session は memo を None にして持たない。"""
+
+    def __init__(self, cb: CompiledBoard, memo: Optional[TranspositionTable], paths, proven: bool):
+        self.cb = cb
+        self.memo = memo
+        self.paths = paths
+        self.proven = proven
+
+def changed_cells(old: CompiledBoard, new: CompiledBoard) -> int:
+    mask = 0
+    for i in range(new.width * new.height):
+        if (old.ctype[i], old.color[i], old.hp[i]) != (new.ctype[i], new.color[i], new.hp[i]):
+            mask |= 1 << i
+    return mask
+
+def unaffected_by(cb: CompiledBoard, pos: int, visited: int, changed: int) -> bool:
+    # 局面までの経路（visited）も、その先で到達しうるマスも編集箇所に触れていなければ結果は変わらない
+    if visited & changed:
+        return False
+    # reachable_mask と同じ塗りつぶしだが、編集箇所に届いた時点で打ち切る
+    free = (cb.open_mask | changed) & ~visited
+    w = cb.width
+    region = 1 << pos
+    while True:
+        h = region | ((region >> 1) & cb.not_last_col) | ((region << 1) & cb.not_first_col)
+        grown = ((h | (h << w) | (h >> w)) & free) | region
+        if grown & changed:
+            return False
+        if grown == region:
+            return True
+        region = grown
+
+def simulate_board_warm(board, session: Optional[SolveSession] = None, max_steps=200000, beam_width=300, time_budget_ms=None, tt_size_mb=None, progress=None, top_k=BEST_K,
+                        on_sample=None, sample_every=SAMPLE_EVERY):
+    """memo モードの探索を前回の session から再開する。(best, stats, 新しい session) を返す。
+
+    前回の best の経路のうち今の盤面でも辿れるものは暫定解（枝刈りの初期値）にする。
+    置換表は前回の探索が完了していて、前回の最良スコアが今も達成できるときだけ引き継ぎ、
+    編集したマスに触れうるエントリだけを捨てる。今回の探索も完了したときだけ置換表を新しい session に引き継ぐ
+    （渡した session は使い回さない）。打ち切ったときは置換表を捨て、画面のセッションに大きな表を残さない。"""
+    cb = board if isinstance(board, CompiledBoard) else compile_board(board)
+    initial = initial_state(cb)
+    deadline = None if time_budget_ms is None else time.perf_counter() + time_budget_ms / 1000
+    stats = {"search_time_ms": 0, "nodes_visited": 0, "warm_start": False, "seed_paths": 0, "tt_invalidated": 0}
+    t0 = time.time()
+
+    seed = BestPaths(top_k, cb)
+    memo = None
+    if session is not None:
+        old = session.cb
+        compatible = (old.width, old.height, old.start, old.boss_cells) == (cb.width, cb.height, cb.start, cb.boss_cells)
+        for path in session.paths:
+            s = replay_path(cb, path)
+            if s is not None:
+                update_best(seed, s)
+        stats["seed_paths"] = len(seed)
+        old_best = replay_path(old, session.paths[0]) if session.paths else None
+        if compatible and session.proven and session.memo is not None and seed and old_best is not None \
+                and score_key(seed[0].boss_killed, seed[0].length) == score_key(old_best.boss_killed, old_best.length):
+            memo = session.memo
+            memo.hits = memo.misses = memo.evictions = 0
+            changed = changed_cells(old, cb)
+            stats["tt_invalidated"] = memo.invalidate(lambda key, visited: unaffected_by(cb, key[0], visited, changed))
+            stats["warm_start"] = True
+    if memo is None:
+        memo = TranspositionTable(tt_size_mb, track_visited=True)
+
+    counters = {}
+    if deadline is not None:
+        best, complete = anytime_search(initial, cb, deadline, memo, max_steps=max_steps, beam_width=beam_width, counters=counters, seed=seed, progress=progress, top_k=top_k,
+                                        on_sample=on_sample, sample_every=sample_every)
+    else:
+        best = seed
+        complete = dfs_with_memo(initial, cb, best, memo, max_steps=max_steps, counters=counters, progress=progress,
+                                 on_sample=on_sample, sample_every=sample_every)
+
+    elapsed = time.time() - t0
+    stats.update(search_stats(counters, elapsed))
+    stats["proven_optimal"] = complete
+    stats["cancelled"] = progress is not None and progress.cancelled
+    stats.update(memo.stats())
+    stats["search_time_ms"] = int(elapsed * 1000)
+    stats["boss_mask"] = best[0].boss_mask if best else 0
+    stats["optimal_paths"] = best.total
+    stats["optimal_paths_exact"] = False
+    new_session = SolveSession(cb, memo if complete else None, [s.path for s in best[:WARM_MAX_PATHS]], complete)
+    return best, stats, new_session
+
+# --------------------
+# バックグラウンド実行: 画面を止めずに解き、途中経過の表示とキャンセルを受け付ける
+# --------------------
+class SolveProgress:
+    """探索スレッドが書き、画面側が読む途中経過。キャンセル要求もここで受け渡す。"""
+
+    def __init__(self):
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.nodes = 0
+        self.best_key = -1
+        self.best_bosses = 0
+        self.best_length = 0
+        self.best_path: List[Tuple[int, int]] = []
+        self.counts: dict = {}
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def report(self, nodes: int, best: List[State]):
+        key = score_key(best[0].boss_killed, best[0].length) if best else -1
+        with self._lock:
+            self.nodes += nodes
+            if key > self.best_key:
+                # 経路の復元は暫定解が良くなったときだけ
+                self.best_key = key
+                self.best_bosses = best[0].boss_killed
+                self.best_length = best[0].length
+                self.best_path = best[0].path
+
+    def sample(self, counts: dict):
+        # simulate_board の on_sample にそのまま渡せる
+        with self._lock:
+            self.counts = dict(counts)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "nodes_visited": self.nodes,
+                "best_bosses": self.best_bosses,
+                "best_length": self.best_length,
+                "best_path": list(self.best_path),
+                "elapsed_ms": int((time.time() - self.started) * 1000),
+                "counts": dict(self.counts),
+            }
+
+class SolveJob:
+    """fn(*args, progress=..., **kwargs) を別スレッドで実行する。結果は result、例外は error に入る。"""
+
+    def __init__(self, fn, *args, **kwargs):
+        self.progress = SolveProgress()
+        self.result = None
+        self.error = None
+        self._thread = threading.Thread(target=self._run, args=(fn, args, kwargs), daemon=True)
+        self._thread.start()
+
+    def _run(self, fn, args, kwargs):
+        try:
+            self.result = fn(*args, progress=self.progress, **kwargs)
+        except Exception as e:
+            self.error = e
+
+    @property
+    def running(self) -> bool:
+        return self._thread.is_alive()
+
+    def cancel(self):
+        self.progress.cancel()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+
+# --------------------
+# バッチ実行 / CLI
+# --------------------
+def board_from_json(obj):
+    """JSON 1 行ぶんの盤面。行のリスト（各行は文字列かトークンのリスト）か、
+    {"id": ..., "board": 行のリスト} の形を受け付ける。(id, 盤面) を返す。"""
+    board_id = None
+    if isinstance(obj, dict):
+        board_id = obj.get("id")
+        obj = obj["board"]
+    rows = [row if isinstance(row, str) else " ".join(t if t else "." for t in row) for row in obj]
+    return board_id, board_from_rows(rows)
+
+def read_boards(lines):
+    """JSON lines と盤面テキスト（空行区切り）のどちらも読める。(id, 盤面) を順に返す。"""
+    block = []
+    count = 0
+    for line in lines:
+        text = line.strip()
+        if text.startswith("[") or text.startswith("{"):
+            # 直前のグリッドが空行なしで JSON 行に続いていても、そこまでを 1 盤面として先に返す
+            if block:
+                yield count, board_from_rows(block)
+                count += 1
+                block = []
+            board_id, board = board_from_json(json.loads(text))
+            yield (count if board_id is None else board_id), board
+            count += 1
+            continue
+        if text:
+            block.append(text)
+            continue
+        if block:
+            yield count, board_from_rows(block)
+            count += 1
+            block = []
+    if block:
+        yield count, board_from_rows(block)
+
+def result_to_dict(board_id, best: List[State], stats, max_paths=1) -> dict:
+    b = best[0] if best else None
+    return {
+        "id": board_id,
+        "boss_killed": b.boss_killed if b else 0,
+        "distance": max(0, b.length - 1) if b else 0,
+        "attack": b.attack if b else 0,
+        "paths": [s.path for s in best[:max_paths]],
+        "stats": stats,
+    }
+
+def _solve_one(item, options, max_paths):
+    board_id, board = item
+    try:
+        best, stats = simulate_board(board, **options)
+    except (ValueError, IndexError) as e:
+        # 1 盤面の不備でバッチ全体を止めない
+        return {"id": board_id, "error": str(e)}
+    return result_to_dict(board_id, best, stats, max_paths)
+
+# simulate_boards でワーカー 1 つあたりに先読みして投入しておく盤面数
+SUBMIT_WINDOW = 2
+
+def simulate_boards(boards, workers=None, max_paths=1, **options):
+    """複数盤面をプロセスプールで解き、入力順に結果の dict を返すジェネレータ。
+    boards は盤面テキストの文字列（JSON 1 行、または行区切りのグリッド）か (id, 盤面) の組。"""
+    def items():
+        for i, b in enumerate(boards):
+            if isinstance(b, str):
+                parsed = list(read_boards(b.splitlines()))
+                if not parsed:
+                    continue
+                board_id, board = parsed[0]
+                yield (i if isinstance(board_id, int) else board_id), board
+            else:
+                yield b
+
+    if workers == 1:
+        for item in items():
+            yield _solve_one(item, options, max_paths)
+        return
+    # 投入済みで結果を返していない盤面は (ワーカー数 x SUBMIT_WINDOW) 個まで。
+    # 入力を読みながら解き、先頭の盤面が解け次第返すので、標準入力から流し込んでも順に出力される
+    window = (workers or os.cpu_count() or 1) * SUBMIT_WINDOW
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for item in items():
+            pending.append(pool.submit(_solve_one, item, options, max_paths))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m core.kouma_game", description="降魔の盤面をまとめて解き、結果を JSON lines で出力する")
+    parser.add_argument("input", nargs="?", default="-", help="盤面ファイル（JSON lines または空行区切りのグリッド）。省略時は標準入力")
+    parser.add_argument("--mode", default="memo", choices=["memo", "nomemo", "beam", "mcts"])
+    parser.add_argument("--max-steps", type=int, default=200000)
+    parser.add_argument("--beam-width", type=int, default=300)
+    parser.add_argument("--time-budget-ms", type=int, default=None)
+    parser.add_argument("--tt-size-mb", type=float, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--paths", type=int, default=1, help="盤面ごとに出力する経路数（探索中に保持する同点経路もこの数まで）")
+    args = parser.parse_args(argv)
+
+    f = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    try:
+        results = simulate_boards(
+            read_boards(f), workers=args.workers, max_paths=args.paths, mode=args.mode,
+            max_steps=args.max_steps, beam_width=args.beam_width,
+            time_budget_ms=args.time_budget_ms, tt_size_mb=args.tt_size_mb, top_k=max(1, args.paths),
+        )
+        for r in results:
+            sys.stdout.write(json.dumps(r, ensure_ascii=False) + "\n")
+            sys.stdout.flush()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+# --------------------
+# ベンチマーク
+# --------------------
+# ベンチマーク用に手で作った 7x7 の合成盤面（"." は空マス）。降魔ページの実際の盤面ではない
+DEFAULT_BOARDS = {
+    "open": [
+        ". . R R . . .",
+        ". R . . G . .",
+        "R . B5 . . G .",
+        ". . . P . . .",
+        ". Y . . . B10 .",
+        ". . Y . C . .",
+        "B3 . . Y . . .",
+    ],
+    "walled": [
+        "R R X . G G .",
+        "R . X . . G .",
+        ". . X P . . .",
+        "X X X . X X X",
+        ". B5 . . . . .",
+        ". . T_R5 . C . .",
+        "Y Y . . . . B8",
+    ],
+    "treasure": [
+        "P R R . . . .",
+        ". . R T_R5 . . .",
+        ". X . . . X .",
+        ". B3 . C . . G",
+        ". . . . . G G",
+        ". X . . T_G5 . .",
+        ". . . B6 . . B12",
+    ],
+}
+
+def _run_memo(board, key_fn, max_steps):
+    cb = compile_board(board)
+    initial = initial_state(cb)
+    best, memo, counters = [], TranspositionTable(), {}
+    t0 = time.perf_counter()
+    # キーの計算コストだけを比べたいので、上界の枝刈りと支配索引（どちらも塗りつぶしを使う）は切る
+    dfs_with_memo(initial, cb, best, memo, max_steps=max_steps, key_fn=key_fn, counters=counters, prune=False, dominance=False)
+    return counters["expanded"], time.perf_counter() - t0
+
+def bench_zobrist(max_steps=50000, boards=None):
+    """降魔の既定盤面で memo_key のフル再計算版と差分更新版の nodes/sec を比較する。"""
+    boards = DEFAULT_BOARDS if boards is None else boards
+    results = {}
+    for name, rows in boards.items():
+        board = board_from_rows(rows)
+        row = {}
+        for label, key_fn in (("full", memo_key_full), ("incremental", memo_key)):
+            nodes, sec = _run_memo(board, key_fn, max_steps)
+            row[label] = int(nodes / sec) if sec > 0 else 0
+        results[name] = row
+    return results
+
+def _scan_cells(board, x, y, visited):
+    # bench_compile 用: コンパイル前と同じく directions / valid / Enum 比較で合法手を数える
+    height = len(board)
+    width = len(board[0])
+    count = 0
+    for dx, dy in directions:
+        nx, ny = x + dx, y + dy
+        if not valid(nx, ny, width, height):
+            continue
+        if visited & bit(nx, ny, width):
+            continue
+        if board[ny][nx].type == CellType.OBSTACLE:
+            continue
+        count += 1
+    return count
+
+def _scan_compiled(cb, pos, visited):
+    count = 0
+    for n in cb.neighbors[pos]:
+        if not visited & (1 << n):
+            count += 1
+    return count
+
+def bench_compile(repeat=20000, max_steps=50000, boards=None):
+    """compile_board の効果を測る。近傍走査 1 回あたりの時間 (ns) と各モードの処理時間を返す。"""
+    boards = DEFAULT_BOARDS if boards is None else boards
+    rng = random.Random(1)
+    results = {}
+    for name, rows in boards.items():
+        board = board_from_rows(rows)
+        t0 = time.perf_counter()
+        cb = compile_board(board)
+        compile_us = (time.perf_counter() - t0) * 1e6
+        n_cells = cb.width * cb.height
+        samples = [(rng.randrange(n_cells), rng.getrandbits(n_cells)) for _ in range(repeat)]
+
+        t0 = time.perf_counter()
+        for pos, visited in samples:
+            _scan_cells(board, pos % cb.width, pos // cb.width, visited)
+        cells_ns = (time.perf_counter() - t0) * 1e9 / repeat
+        t0 = time.perf_counter()
+        for pos, visited in samples:
+            _scan_compiled(cb, pos, visited)
+        compiled_ns = (time.perf_counter() - t0) * 1e9 / repeat
+
+        row = {"compile_us": int(compile_us), "scan_cells_ns": int(cells_ns), "scan_compiled_ns": int(compiled_ns)}
+        for mode in ("nomemo", "memo", "beam"):
+            t0 = time.perf_counter()
+            _, stats = simulate_board(cb, mode=mode, max_steps=max_steps)
+            sec = time.perf_counter() - t0
+            row[mode + "_ms"] = int(sec * 1000)
+            if stats["nodes_visited"] >= 0:
+                row[mode + "_nodes_per_sec"] = int(stats["nodes_visited"] / sec) if sec > 0 else 0
+        results[name] = row
+    return results
+
+if __name__ == "__main__":
+    main()
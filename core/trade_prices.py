@@ -0,0 +1,186 @@
+# core/trade_prices.py
+# 航路系ページ（航路計算 / 航路最適経路 / test）共通の価格テンソル。
+# price_matrix（品目 -> 港 -> 価格 の dict）を (品目 x 港) の int 配列に詰め替え、
+# 全ての (出発港, 到着港) の組の利益・乗数を numpy で一度にまとめて計算する。
+import math
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# 在庫の指定が無い（無制限）ときに使う上限。cash // buy と min を取るだけなので十分大きければよい
+UNLIMITED = np.iinfo(np.int64).max // 4
+
+# optimal_plans の分枝限定で 1 到着港あたりに調べる節点数の上限。超えたらそこまでの最良計画を返し、最適とは限らない印をつける
+KNAPSACK_NODE_LIMIT = 200000
+
+def lp_bound(buys, ups, caps, start: int, cash: int) -> float:
+    # start 以降の品目（利益率の高い順）を所持金 cash で端数も買えるとしたときの利益。整数解の上界
+    bound = 0.0
+    for j in range(start, len(buys)):
+        b = buys[j]
+        if caps[j] * b <= cash:
+            cash -= caps[j] * b
+            bound += caps[j] * ups[j]
+        else:
+            return bound + cash * ups[j] / b
+    return bound
+
+def knapsack_bb(buys, ups, caps, cash: int, incumbent: int = 0, node_limit: int = KNAPSACK_NODE_LIMIT):
+    """有界ナップサック: sum(q * buy) <= cash, 0 <= q <= cap で sum(q * up) を最大化する。
+    品目は利益率 up / buy の高い順に並べて渡す。(最大利益, 個数のリスト, 探索し尽くしたか) を返し、
+    incumbent 以下の解しか無ければ個数のリストは None。node_limit で打ち切ったときは 3 つ目が False で、
+    返す利益は最適値の下限になる。"""
+    n = len(buys)
+    best = [incumbent, None]
+    qty = [0] * n
+    nodes = [0]
+
+    def dfs(i, rem, val):
+        nodes[0] += 1
+        if val > best[0]:
+            best[0] = val
+            best[1] = qty[:i] + [0] * (n - i)
+        if i == n or nodes[0] > node_limit:
+            return
+        b, u = buys[i], ups[i]
+        for q in range(min(caps[i], rem // b), -1, -1):
+            # 利益率順なので q を減らすほど上界は下がる。上界が最良値を超えなくなったら打ち切る
+            if math.floor(val + q * u + lp_bound(buys, ups, caps, i + 1, rem - q * b) + 1e-9) <= best[0]:
+                break
+            qty[i] = q
+            dfs(i + 1, rem - q * b, val + q * u)
+        qty[i] = 0
+
+    dfs(0, cash, 0)
+    return best[0], best[1], nodes[0] <= node_limit
+
+class PriceTensor:
+    """prices[i, j] が品目 i の港 j での価格。品目名・港名から添字へは item_index / port_index で引く。"""
+
+    def __init__(self, items: List[str], ports: List[str], prices):
+        self.items = list(items)
+        self.ports = list(ports)
+        self.item_index = {name: i for i, name in enumerate(self.items)}
+        self.port_index = {p: j for j, p in enumerate(self.ports)}
+        self.prices = np.asarray(prices, dtype=np.int64).reshape(len(self.items), len(self.ports))
+        self._unit_profit = None
+
+    @classmethod
+    def from_matrix(cls, price_matrix: Dict[str, Dict[str, int]], items: List[str], ports: List[str]) -> "PriceTensor":
+        # 無い品目・港は 0（fetch_price_matrix_from_csv_auto と同じ扱い）
+        prices = [[price_matrix.get(name, {}).get(p, 0) for p in ports] for name in items]
+        return cls(items, ports, prices)
+
+    def price(self, item: str, port: str) -> int:
+        return int(self.prices[self.item_index[item], self.port_index[port]])
+
+    @property
+    def unit_profit(self) -> np.ndarray:
+        """(品目, 出発港, 到着港) の 1 個あたり利益 = 到着港の価格 - 出発港の価格。初回だけ計算する。"""
+        if self._unit_profit is None:
+            self._unit_profit = self.prices[:, None, :] - self.prices[:, :, None]
+        return self._unit_profit
+
+    def stock_vector(self, stock: Optional[Dict[str, int]]) -> np.ndarray:
+        # None は在庫無制限
+        if stock is None:
+            return np.full(len(self.items), UNLIMITED, dtype=np.int64)
+        return np.array([max(0, int(stock.get(name, 0) or 0)) for name in self.items], dtype=np.int64)
+
+    def greedy_plans(self, origin: str, cash: int, stock: Optional[Dict[str, int]]) -> List[Tuple[list, int, int]]:
+        """origin から各港へ向かうときの購入計画を全到着港ぶんまとめて作る。ports と同じ順の
+        (plan, total_cost, total_profit) のリストを返す。plan は (品目, 個数, 買値, 売値, 1 個あたり利益)。
+
+        各品目を「1 個あたり利益 x min(在庫, 所持金 // 買値)」の大きい順に並べ、残りの所持金で買えるだけ買う。
+        並べ替えまでは全到着港を一度に計算し、買い進める部分だけ港ごとに回す。"""
+        o = self.port_index[origin]
+        cash = int(cash)
+        buy = self.prices[:, o]
+        sell = self.prices
+        up = self.unit_profit[:, o, :]
+        avail = self.stock_vector(stock)
+        safe_buy = np.where(buy > 0, buy, 1)
+        qty = np.minimum(avail, cash // safe_buy)
+        valid = (avail > 0)[:, None] & (buy > 0)[:, None] & (up > 0)
+        score = np.where(valid, up * qty[:, None], -1)
+        # 同点は品目の並び順（ITEMS 順）のまま
+        order = np.argsort(-score, axis=0, kind="stable")
+
+        plans = []
+        for d in range(len(self.ports)):
+            remaining_cash = cash
+            plan = []
+            for i in order[:, d]:
+                if not valid[i, d]:
+                    break
+                b = int(buy[i])
+                q = min(int(avail[i]), remaining_cash // b)
+                if q <= 0:
+                    continue
+                plan.append((self.items[i], q, b, int(sell[i, d]), int(up[i, d])))
+                remaining_cash -= q * b
+                if remaining_cash <= 0:
+                    break
+            total_cost = sum(q * b for _, q, b, _, _ in plan)
+            total_profit = sum(q * u for _, q, _, _, u in plan)
+            plans.append((plan, total_cost, total_profit))
+        return plans
+
+    def optimal_plans(self, origin: str, cash: int, stock: Optional[Dict[str, int]], greedy=None) -> List[Tuple[list, int, int, bool]]:
+        """所持金と在庫の範囲で利益が最大の購入計画（有界ナップサックの厳密解）を、ports と同じ順の
+        (plan, total_cost, total_profit, exact) のリストで返す。最初の 3 つは greedy_plans と同じで、exact は
+        分枝限定を最後まで回せたか（False なら KNAPSACK_NODE_LIMIT で打ち切った暫定解で、利益は最適値の下限）。
+        利益の出る品目の抽出と利益率順の並べ替えは全到着港ぶんまとめて行い、分枝限定だけ港ごとに回す。
+        greedy（greedy_plans の結果）を渡すとそれを暫定解にする。"""
+        o = self.port_index[origin]
+        cash = int(cash)
+        greedy = self.greedy_plans(origin, cash, stock) if greedy is None else greedy
+        buy = self.prices[:, o]
+        up = self.unit_profit[:, o, :]
+        avail = self.stock_vector(stock)
+        safe_buy = np.where(buy > 0, buy, 1)
+        cap = np.minimum(avail, cash // safe_buy)
+        valid = (cap > 0)[:, None] & (buy > 0)[:, None] & (up > 0)
+        rate = np.where(valid, up / safe_buy[:, None], -1.0)
+        order = np.argsort(-rate, axis=0, kind="stable")
+
+        plans = []
+        for d in range(len(self.ports)):
+            idx = [int(i) for i in order[:, d] if valid[i, d]]
+            buys = [int(buy[i]) for i in idx]
+            ups = [int(up[i, d]) for i in idx]
+            caps = [int(cap[i]) for i in idx]
+            g_plan, g_cost, g_profit = greedy[d]
+            profit, qty, exact = knapsack_bb(buys, ups, caps, cash, incumbent=g_profit)
+            if qty is None:
+                plans.append((g_plan, g_cost, g_profit, exact))
+                continue
+            plan = [(self.items[i], q, buys[k], int(self.prices[i, d]), ups[k]) for k, (i, q) in enumerate(zip(idx, qty)) if q > 0]
+            plans.append((plan, sum(q * b for _, q, b, _, _ in plan), profit, exact))
+        return plans
+
+    def one_item_steps(self, cash: int) -> Dict[str, np.ndarray]:
+        """全 (出発港, 到着港) について、利益率 (売値 - 買値) / 買値 が最大の 1 品目を所持金で買えるだけ買ったときの結果。
+        どれも (港, 港) の配列で、item は品目の添字（買える品目が無ければ -1）。"""
+        cash = int(max(1, cash))
+        buy = np.broadcast_to(self.prices[:, :, None], self.unit_profit.shape)
+        up = self.unit_profit
+        valid = (buy > 0) & (up > 0)
+        rate = np.where(valid, up / np.where(buy > 0, buy, 1), -1.0)
+        # argmax は同率なら先頭（ITEMS 順で最初）の品目を選ぶ
+        best = np.argmax(rate, axis=0)
+        found = np.take_along_axis(rate, best[None], axis=0)[0] > 0
+        best_buy = np.take_along_axis(buy, best[None], axis=0)[0]
+        best_up = np.take_along_axis(up, best[None], axis=0)[0]
+        qty = np.where(found, cash // np.where(best_buy > 0, best_buy, 1), 0)
+        profit = qty * best_up
+        cash_after = cash + profit
+        return {
+            "item": np.where(found, best, -1),
+            "buy": np.where(found, best_buy, 0),
+            "sell": np.where(found, best_buy + best_up, 0),
+            "qty": qty,
+            "profit": profit,
+            "cash_after": cash_after,
+            "multiplier": cash_after / float(cash),
+        }
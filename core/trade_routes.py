@@ -0,0 +1,199 @@
+# core/trade_routes.py
+# 航路の周回ルート探索。港を頂点、一手の乗数を辺の重みとするグラフで、
+# 乗数の幾何平均（= log 乗数の平均）が最大になる周回を厳密に求める。
+# mul は (港, 港) の乗数行列（PriceTensor.one_item_steps の "multiplier" など）。
+# 自己ループや使えない辺は 0 以下（-inf など）にしておく。
+import heapq
+import math
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from core.trade_prices import PriceTensor
+
+def log_weights(mul: np.ndarray, allowed: Optional[np.ndarray] = None) -> np.ndarray:
+    """乗数行列を log に直す。乗数が 0 以下の辺・自己ループ・allowed 外の港に出入りする辺は -inf。"""
+    mul = np.asarray(mul, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        w = np.where(mul > 0, np.log(np.where(mul > 0, mul, 1.0)), -np.inf)
+    np.fill_diagonal(w, -np.inf)
+    if allowed is not None:
+        allowed = np.asarray(allowed, dtype=bool)
+        w = np.where(allowed[:, None] & allowed[None, :], w, -np.inf)
+    return w
+
+def split_cycles(walk: List[int]) -> List[List[int]]:
+    # 頂点列（歩道）を単純閉路に分解する。閉路は [v0, ..., v0] の形
+    cycles = []
+    stack = []
+    pos = {}
+    for v in walk:
+        if v in pos:
+            i = pos[v]
+            cycle = stack[i:] + [v]
+            cycles.append(cycle)
+            for u in stack[i + 1:]:
+                del pos[u]
+            del stack[i + 1:]
+        else:
+            pos[v] = len(stack)
+            stack.append(v)
+    return cycles
+
+def cycle_mean(w: np.ndarray, cycle: List[int]) -> float:
+    return sum(w[a, b] for a, b in zip(cycle, cycle[1:])) / (len(cycle) - 1)
+
+def max_mean_cycle(mul: np.ndarray, allowed: Optional[np.ndarray] = None) -> Tuple[Optional[List[int]], float]:
+    """log 乗数の平均が最大の単純閉路（Karp の最大平均閉路）。(閉路 [v0, ..., v0], 平均 log 乗数) を返す。
+    閉路が無ければ (None, -inf)。"""
+    w = log_weights(mul, allowed)
+    n = w.shape[0]
+    if n == 0:
+        return None, -math.inf
+    # D[k, v]: 任意の頂点から出発して v で終わる長さ k の歩道の最大重み
+    D = np.full((n + 1, n), -np.inf)
+    D[0] = 0.0
+    if allowed is not None:
+        D[0] = np.where(np.asarray(allowed, dtype=bool), 0.0, -np.inf)
+    parent = np.zeros((n + 1, n), dtype=np.int64)
+    for k in range(1, n + 1):
+        cand = D[k - 1][:, None] + w
+        parent[k] = np.argmax(cand, axis=0)
+        D[k] = cand[parent[k], np.arange(n)]
+
+    # 平均の最大値を持つ閉路は、長さ n の最大重み歩道のどれかに含まれる。
+    # 全ての終点について歩道を復元・分解し、平均の最大な閉路を選ぶ
+    best_cycle = None
+    best_mean = -math.inf
+    for v in range(n):
+        if not np.isfinite(D[n, v]):
+            continue
+        walk = [v]
+        for k in range(n, 0, -1):
+            walk.append(int(parent[k, walk[-1]]))
+        walk.reverse()
+        for cycle in split_cycles(walk):
+            m = cycle_mean(w, cycle)
+            if m > best_mean:
+                best_mean = m
+                best_cycle = cycle
+    return best_cycle, best_mean
+
+def max_mean_cycle_from(mul: np.ndarray, start: int, allowed: Optional[np.ndarray] = None, max_len: Optional[int] = None) -> Tuple[Optional[List[int]], float]:
+    """start を通る長さ max_len 以下の単純閉路（start 以外の港は 1 度ずつ）のうち、log 乗数の平均が最大のもの。
+    (周回 [start, ..., start], 平均 log 乗数) を返し、閉路が無ければ (None, -inf)。
+    top_k_cycles と同じ DFS を start だけを根にして回す。港数に対して指数的に増えるので max_len で絞って使う。"""
+    w = log_weights(mul, allowed)
+    n = w.shape[0]
+    max_len = n if max_len is None else max_len
+    finite = np.isfinite(w)
+    if not finite.any():
+        return None, -math.inf
+    outs = [np.flatnonzero(finite[u]).tolist() for u in range(n)]
+    w_max = float(w[finite].max())
+    best_cycle = None
+    best_mean = -math.inf
+
+    stack = [(start, [start], 0.0)]
+    while stack:
+        u, path, total = stack.pop()
+        # 残りの辺を全て最大の重みで進んでも今の最良に届かない経路は伸ばさない。
+        # 平均は足す辺の本数について単調なので、1 本で閉じる場合と max_len まで伸ばす場合を見れば足りる
+        edges = len(path) - 1
+        bound = max((total + w_max) / (edges + 1), (total + (max_len - edges) * w_max) / max_len)
+        if bound <= best_mean:
+            continue
+        for v in outs[u]:
+            if v == start:
+                mean = (total + w[u, v]) / len(path)
+                # 同じ平均なら先に見つかった周回を残す
+                if mean > best_mean:
+                    best_mean = mean
+                    best_cycle = path + [start]
+            elif v not in path and len(path) < max_len:
+                stack.append((v, path + [v], total + w[u, v]))
+    return best_cycle, best_mean
+
+def top_k_cycles(mul: np.ndarray, k: int = 5, max_len: int = 4, allowed: Optional[np.ndarray] = None) -> List[Tuple[List[int], float]]:
+    """長さ max_len 以下の単純閉路を log 乗数の平均の大きい順に k 個。各閉路は最小添字の港から始まる。"""
+    w = log_weights(mul, allowed)
+    n = w.shape[0]
+    finite = np.isfinite(w)
+    outs = [np.flatnonzero(finite[u]).tolist() for u in range(n)]
+    heap = []  # (平均, 通し番号, 閉路) の最小ヒープで上位 k 個を保つ
+    counter = 0
+
+    for root in range(n):
+        # root より大きい添字の港だけを通る閉路を数えるので、同じ閉路を 2 度数えない
+        stack = [(root, [root], 0.0)]
+        while stack:
+            u, path, total = stack.pop()
+            for v in outs[u]:
+                if v == root:
+                    mean = (total + w[u, v]) / len(path)
+                    counter += 1
+                    item = (mean, counter, path + [root])
+                    if len(heap) < k:
+                        heapq.heappush(heap, item)
+                    elif mean > heap[0][0]:
+                        heapq.heapreplace(heap, item)
+                elif v > root and v not in path and len(path) < max_len:
+                    stack.append((v, path + [v], total + w[u, v]))
+    return [(cycle, mean) for mean, _, cycle in sorted(heap, key=lambda t: (-t[0], t[1]))]
+
+def plan_voyages(prices: PriceTensor, start: str, cash: int, voyages: int) -> Optional[Dict]:
+    """start から voyages 回航海したあとの所持金が最大になる航路（所持金を複利で持ち越す）。
+    各航海では利益の出る 1 品目をその時点の所持金で買えるだけ買う（在庫は無制限とみなす）。
+    所持金が多いほど後の航海でも損をしないので、(港, 航海回数) ごとに最大の所持金だけ残す DP で厳密に解ける。
+    {"final_cash", "route", "steps"} を返す。steps は from / to / chosen_item / qty / cash_before / cash_after / multiplier。"""
+    ports = prices.ports
+    n = len(ports)
+    s = prices.port_index[start]
+    # 組ごとの買値・1 個あたり利益の表は PriceTensor にあるものを毎回使い回す
+    buy = prices.prices
+    up = prices.unit_profit
+    valid = (buy > 0)[:, :, None] & (up > 0)
+    safe_buy = np.where(buy > 0, buy, 1)
+    diag = np.eye(n, dtype=bool)
+
+    C = np.full(n, -1, dtype=np.int64)
+    C[s] = int(cash)
+    from_port = np.zeros((voyages + 1, n), dtype=np.int64)
+    item_at = np.full((voyages + 1, n), -1, dtype=np.int64)
+    for t in range(1, voyages + 1):
+        # after[i, p, q]: 港 p で品目 i を買えるだけ買い、港 q で売ったあとの所持金（利益の出ない品目は買わない）
+        qty = (np.maximum(C, 0)[None, :] // safe_buy)[:, :, None]
+        after = np.where(valid, C[None, :, None] + qty * up, C[None, :, None])
+        item = np.argmax(after, axis=0)
+        val = np.take_along_axis(after, item[None], axis=0)[0]
+        item = np.where(val > C[:, None], item, -1)
+        val = np.where((C[:, None] >= 0) & ~diag, val, -1)
+        from_port[t] = np.argmax(val, axis=0)
+        item_at[t] = item[from_port[t], np.arange(n)]
+        C = val[from_port[t], np.arange(n)]
+    if voyages <= 0 or C.max() < 0:
+        return None
+
+    q = int(np.argmax(C))
+    route = [q]
+    for t in range(voyages, 0, -1):
+        route.append(int(from_port[t, route[-1]]))
+    route.reverse()
+
+    steps = []
+    c = int(cash)
+    for t, (a, b) in enumerate(zip(route, route[1:]), start=1):
+        i = int(item_at[t, b])
+        qty = c // int(buy[i, a]) if i >= 0 else 0
+        after = c + qty * int(up[i, a, b]) if i >= 0 else c
+        steps.append({
+            "from": ports[a],
+            "to": ports[b],
+            "chosen_item": prices.items[i] if i >= 0 else None,
+            "qty": qty,
+            "cash_before": c,
+            "cash_after": after,
+            "multiplier": after / c if c > 0 else 1.0,
+        })
+        c = after
+    return {"final_cash": c, "route": [ports[i] for i in route], "steps": steps}
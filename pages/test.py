@@ -6,6 +6,7 @@ import numpy as np
 import re
 import requests
 from io import StringIO
+from core.trade_prices import PriceTensor
 
 st.set_page_config(page_title="効率よく買い物しよう！", layout="wide")
 
@@ -75,49 +76,6 @@ def numeric_input_optional_strict(label: str, key: str, placeholder: str = "", a
     st.session_state[invalid_flag] = False
     return val
 
-# --------------------
-# 既存の最適化ロジック（そのまま）
-# --------------------
-def greedy_plan_for_destination(current_port: str, dest_port: str, cash: int, stock: Dict[str,int], price_matrix: Dict[str,Dict[str,int]]):
-    candidates = []
-    for item, base in ITEMS:
-        avail = stock.get(item, 0)
-        if avail <= 0:
-            continue
-        buy = price_matrix[item][current_port]
-        sell = price_matrix[item][dest_port]
-        unit_profit = sell - buy
-        if unit_profit <= 0:
-            continue
-        candidates.append((item, buy, sell, unit_profit, avail))
-
-    # ★ 利益額 greedy（最重要修正ポイント）
-    def score(c):
-        _, buy, _, unit_profit, avail = c
-        if buy <= 0:
-            return 0
-        max_by_cash = cash // buy
-        qty = min(avail, max_by_cash)
-        return unit_profit * qty  # ←利益額
-
-    candidates.sort(key=score, reverse=True)
-
-    remaining_cash = cash
-    plan = []
-    for item, buy, sell, unit_profit, avail in candidates:
-        max_by_cash = remaining_cash // buy if buy > 0 else 0
-        qty = min(avail, max_by_cash)
-        if qty <= 0:
-            continue
-        plan.append((item, qty, buy, sell, unit_profit))
-        remaining_cash -= qty * buy
-        if remaining_cash <= 0:
-            break
-
-    total_cost = sum(q * b for _, q, b, _, _ in plan)
-    total_profit = sum(q * up for _, q, _, _, up in plan)
-    return plan, total_cost, total_profit
-
 # --------------------
 # CSV から価格表を取得して price_matrix を作る
 # price_matrix: { item_name: { port_name: price_int, ... }, ... }
@@ -180,6 +138,9 @@ except Exception as e:
     st.error(f"スプレッドシート（CSV）からの読み込みに失敗しました: {e}")
     st.stop()
 
+# 購入計画は (品目 x 港) の価格テンソルで全到着港ぶんまとめて計算する
+prices = PriceTensor.from_matrix(price_matrix, [name for name, _ in ITEMS], ports)
+
 # 中央レイアウト
 col1, col2, col3 = st.columns([1, 2, 1])
 with col2:
@@ -251,18 +212,20 @@ with col2:
                     current_stock[name] = int(val) if val is not None else 0
 
                 results = []
-                for dest in ports:
+                # 購入計画は所持金・在庫の範囲での最適解（分枝限定を節点数の上限で打ち切った港は暫定解）。貪欲法の計画との差も出す
+                greedy = prices.greedy_plans(current_port, cash, current_stock)
+                plans = prices.optimal_plans(current_port, cash, current_stock, greedy=greedy)
+                for dest, (plan, cost, profit, exact), (_, _, greedy_profit) in zip(ports, plans, greedy):
                     if dest == current_port:
                         continue
-                    plan, cost, profit = greedy_plan_for_destination(current_port, dest, cash, current_stock, price_matrix)
-                    results.append((dest, plan, cost, profit))
+                    results.append((dest, plan, cost, profit, greedy_profit, exact))
                 results.sort(key=lambda x: x[3], reverse=True)
                 top_results = results[:top_k]
 
                 if not top_results or all(r[3] <= 0 for r in top_results):
                     st.info("所持金・在庫の範囲で利益が見込める到着先が見つかりませんでした。")
                 else:
-                    for rank, (dest, plan, cost, profit) in enumerate(top_results, start=1):
+                    for rank, (dest, plan, cost, profit, greedy_profit, exact) in enumerate(top_results, start=1):
                         # そのまま貼れる置換コード（シンプル）
                         st.markdown(
                             f'''
@@ -297,6 +260,12 @@ with col2:
                             unsafe_allow_html=True
                         )
 
+                        if not exact:
+                            # 打ち切った暫定解なので、最適な計画は少なくともこの差だけ貪欲法より良い
+                            st.caption(f"計算量の上限で打ち切った暫定の計画（最適とは限らない）。貪欲法の計画（利益 {greedy_profit:,}）より少なくとも {profit - greedy_profit:,} 多い")
+                        elif profit > greedy_profit:
+                            st.caption(f"貪欲法の計画（利益 {greedy_profit:,}）より {profit - greedy_profit:,} 多い")
+
                         if not plan:
                             st.write("購入候補がありません（利益が出ない、もしくは在庫不足）。")
                             continue
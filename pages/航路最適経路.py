@@ -8,6 +8,8 @@ import requests
 from io import StringIO
 from copy import deepcopy
 from math import prod
+from core.trade_prices import PriceTensor
+from core.trade_routes import max_mean_cycle, max_mean_cycle_from, plan_voyages, top_k_cycles
 
 st.set_page_config(page_title="ルート解析（リッチ表示復元）", layout="wide")
 
@@ -31,7 +33,7 @@ CSV_URL = f"https://docs.google.com/spreadsheets/d/{SPREADSHEET_ID}/export?forma
 SPREADSHEET_URL = f"https://docs.google.com/spreadsheets/d/{SPREADSHEET_ID}/edit#gid={GID}"
 
 # --------------------
-# ヘルパー: 厳格整数テキスト入力（再利用のため残すが UI では使わない）
+# ヘルパー: 厳格整数テキスト入力（複数航海プランの所持金入力で使う）
 # --------------------
 def numeric_input_optional_strict(label: str, key: str, placeholder: str = "", allow_commas: bool = True, min_value: Optional[int] = None, max_value: Optional[int] = None):
     invalid_flag = f"{key}_invalid"
@@ -131,195 +133,74 @@ def fetch_price_matrix_from_csv_auto(url: str):
 # --------------------
 # 既存の解析ロジック（そのまま利用）
 # --------------------
-def greedy_plan_for_destination_general(current_port: str, dest_port: str, cash: int, stock: Optional[Dict[str,int]], price_matrix: Dict[str,Dict[str,int]]):
-    cash = int(cash) if cash is not None else 0
-    candidates = []
-    for item, base in ITEMS:
-        avail = float('inf') if stock is None else stock.get(item, 0)
-        if avail <= 0:
-            continue
-        buy = price_matrix[item].get(current_port, 0)
-        sell = price_matrix[item].get(dest_port, 0)
-        unit_profit = sell - buy
-        if unit_profit <= 0 or buy <= 0:
-            continue
-        candidates.append((item, buy, sell, unit_profit, avail))
-    candidates.sort(key=lambda x: x[3], reverse=True)
-
-    remaining_cash = cash
-    plan = []
-    for item, buy, sell, unit_profit, avail in candidates:
-        if buy <= 0:
-            continue
-        max_by_cash = remaining_cash // buy if remaining_cash >= buy else 0
-        qty = min(avail if avail != float('inf') else max_by_cash, max_by_cash)
-        if qty <= 0:
-            continue
-        plan.append((item, int(qty), int(buy), int(sell), int(unit_profit)))
-        remaining_cash -= qty * buy
-        if remaining_cash <= 0:
-            break
-
-    total_cost = sum(q * b for _, q, b, _, _ in plan)
-    total_profit = sum(q * up for _, q, _, _, up in plan)
-    remaining_cash_after_sell = cash + total_profit
-    return plan, int(total_cost), int(total_profit), int(remaining_cash_after_sell)
-
-def evaluate_with_lookahead(current_port: str, dest_port: str, cash: int, stock: Dict[str,int], price_matrix: Dict[str,Dict[str,int]], second_k: Optional[int] = None):
-    first_plan, first_cost, first_profit, cash_after_sell = greedy_plan_for_destination_general(current_port, dest_port, cash, stock, price_matrix)
-
-    example_item = next(iter(price_matrix))
-    ports_list = list(price_matrix[example_item].keys())
-    second_candidates = [p for p in ports_list if p != dest_port]
-
-    if second_k is not None and second_k < len(second_candidates):
-        scores = []
-        for s in second_candidates:
-            score = 0
-            for item, _ in ITEMS:
-                buy = price_matrix[item].get(dest_port, 0)
-                sell = price_matrix[item].get(s, 0)
-                if buy > 0:
-                    unit = sell - buy
-                    if unit > 0:
-                        score += unit
-            scores.append((s, score))
-        scores.sort(key=lambda x: x[1], reverse=True)
-        second_candidates = [s for s,_ in scores[:second_k]]
-
-    best_second_profit = 0
-    best_second_plan = []
-    best_second_dest = None
-    for s in second_candidates:
-        plan2, cost2, profit2, cash_after2 = greedy_plan_for_destination_general(dest_port, s, cash_after_sell, None, price_matrix)
-        if profit2 > best_second_profit:
-            best_second_profit = profit2
-            best_second_plan = plan2
-            best_second_dest = s
-
-    total_profit = first_profit + best_second_profit
-    return {
-        "total_profit": int(total_profit),
-        "first_profit": int(first_profit),
-        "second_best_profit": int(best_second_profit),
-        "first_plan": first_plan,
-        "second_plan": best_second_plan,
-        "second_dest": best_second_dest,
-        "cash_after_first_sell": int(cash_after_sell)
-    }
-
-def greedy_one_item_for_destination(current_port: str, dest_port: str, cash: int, price_matrix: Dict[str,Dict[str,int]]):
-    cash = int(max(1, cash))
-    best_item = None
-    best_rate = -1.0
-    best_buy = 0
-    best_sell = 0
-
-    for item, _ in ITEMS:
-        buy = price_matrix[item].get(current_port, 0)
-        sell = price_matrix[item].get(dest_port, 0)
-        if buy <= 0:
-            continue
-        unit_profit = sell - buy
-        if unit_profit <= 0:
-            continue
-        rate = unit_profit / float(buy)
-        if rate > best_rate:
-            best_rate = rate
-            best_item = item
-            best_buy = buy
-            best_sell = sell
-
-    if best_item is None:
-        return None, 0, 0, 0, 0, cash
-
-    qty = cash // best_buy if best_buy > 0 else 0
-    if qty <= 0:
-        return best_item, best_buy, best_sell, 0, 0, cash
-
-    step_profit = qty * (best_sell - best_buy)
-    cash_after = cash + step_profit
-    return best_item, best_buy, best_sell, int(qty), int(step_profit), int(cash_after)
-
-def compute_single_step_multipliers_oneitem(price_matrix: Dict[str,Dict[str,int]], from_ports: List[str], to_ports: List[str], cash: int):
+def compute_single_step_multipliers_oneitem(prices: PriceTensor, from_ports: List[str], to_ports: List[str], cash: int):
+    # 全港の組の 1 品目最適化は PriceTensor.one_item_steps で一度に計算し、ここでは from/to に絞って詰め直すだけ
+    steps = prices.one_item_steps(cash)
+    item_idx = steps['item']
+    multipliers = steps['multiplier']
+    cash_after = steps['cash_after']
     mapping = {}
     candidates = []
     for p in from_ports:
         mapping.setdefault(p, {})
+        i = prices.port_index[p]
         for q in to_ports:
             if p == q:
                 continue
-            item, buy, sell, qty, profit, cash_after = greedy_one_item_for_destination(p, q, cash, price_matrix)
-            multiplier = float(cash_after) / float(max(1, cash))
+            j = prices.port_index[q]
+            multiplier = float(multipliers[i, j])
             mapping[p][q] = {
                 'multiplier': multiplier,
-                'chosen_item': item,
-                'cash_after': cash_after,
+                'chosen_item': prices.items[item_idx[i, j]] if item_idx[i, j] >= 0 else None,
+                'cash_after': int(cash_after[i, j]),
             }
             candidates.append((p, q, multiplier))
     candidates.sort(key=lambda x: x[2], reverse=True)
     return mapping, candidates
 
-def build_greedy_cycles_from_start(start_port: str, mapping: Dict, cash: int, allowed_ports: Optional[set] = None, max_iters: int = 2000, max_route_len: int = 200):
-    route_nodes = [start_port]
-    steps = []
-    iters = 0
-
-    while True:
-        iters += 1
-        if iters > max_iters:
-            break
-
-        cur = route_nodes[-1]
-        next_candidates_all = mapping.get(cur, {})
-        if allowed_ports is not None:
-            next_candidates = {q:info for q, info in next_candidates_all.items() if q in allowed_ports or q == start_port}
-        else:
-            next_candidates = next_candidates_all
-
-        if not next_candidates:
-            break
-
-        q, info = max(next_candidates.items(), key=lambda kv: kv[1]['multiplier'])
+def multiplier_matrix(ports: List[str], singles: List[Tuple[str, str, float]]) -> np.ndarray:
+    # compute_single_step_multipliers_oneitem の候補リストを (港, 港) の乗数行列にする。辺の無い組は -inf
+    port_idx = {p: i for i, p in enumerate(ports)}
+    mul = np.full((len(ports), len(ports)), -np.inf)
+    for p, q, m in singles:
+        mul[port_idx[p], port_idx[q]] = m
+    return mul
 
+def route_from_cycle(cycle: List[str], mapping: Dict):
+    # 周回 [p0, ..., p0] を既存のルート表示と同じ (route, steps, final_cash, avg_mul, total_mul) に直す
+    steps = []
+    for a, b in zip(cycle, cycle[1:]):
+        info = mapping[a][b]
         steps.append({
-            'from': cur,
-            'to': q,
+            'from': a,
+            'to': b,
             'multiplier': info.get('multiplier'),
             'chosen_item': info.get('chosen_item'),
         })
-        route_nodes.append(q)
-
-        first_idx = None
-        for idx, node in enumerate(route_nodes[:-1]):
-            if node == q:
-                first_idx = idx
-                break
-        if first_idx is not None:
-            route = route_nodes[first_idx:]
-            cycle_len = len(route) - 1
-            cycle_steps = steps[-cycle_len:] if cycle_len > 0 else []
-            multipliers = [s['multiplier'] for s in cycle_steps]
-            total_mul = prod(multipliers) if multipliers else 1.0
-            avg_mul = total_mul ** (1.0 / len(multipliers)) if multipliers else 1.0
-            last_step_cash = None
-            if cycle_steps:
-                last_from = cycle_steps[-1]['from']
-                last_to = cycle_steps[-1]['to']
-                info_last = mapping.get(last_from, {}).get(last_to, {})
-                last_step_cash = info_last.get('cash_after')
-            final_cash = int(last_step_cash) if last_step_cash is not None else None
-            return route, cycle_steps, final_cash, avg_mul, total_mul
-
-        if len(route_nodes) > max(1, len(mapping) + 5) or len(route_nodes) > max_route_len:
-            break
-
-    return None, None, None, None, None
-
-def generate_routes_greedy_cover_with_recalc(ports: List[str], price_matrix: Dict, cash: int, top_k_start: int = 1):
+    multipliers = [s['multiplier'] for s in steps]
+    total_mul = prod(multipliers) if multipliers else 1.0
+    avg_mul = total_mul ** (1.0 / len(multipliers)) if multipliers else 1.0
+    final_cash = int(mapping[cycle[-2]][cycle[-1]]['cash_after']) if steps else None
+    return cycle, steps, final_cash, avg_mul, total_mul
+
+# 開始港から組む周回の最大の長さ（港数）。単純閉路の列挙は長さに対して指数的に増えるので上限を置く
+ROUTE_MAX_LEN = 6
+
+def build_best_cycle_from_start(start_port: str, ports: List[str], mapping: Dict, mul: np.ndarray, allowed: Optional[np.ndarray] = None):
+    # start_port を通る長さ ROUTE_MAX_LEN 以下の単純閉路のうち乗数の幾何平均が最大のもの（厳密解）
+    cycle, _ = max_mean_cycle_from(mul, ports.index(start_port), allowed=allowed, max_len=ROUTE_MAX_LEN)
+    if cycle is None:
+        return None, None, None, None, None
+    return route_from_cycle([ports[i] for i in cycle], mapping)
+
+def generate_routes_greedy_cover_with_recalc(ports: List[str], prices: PriceTensor, cash: int, top_k_start: int = 1):
     results_per_start = []
 
-    mapping_full, singles = compute_single_step_multipliers_oneitem(price_matrix, ports, ports, cash)
+    # 一手の乗数は価格と所持金だけで決まり、どの港の部分集合で見ても変わらない。
+    # 全港の P x P を一度だけ計算し、残り港への絞り込みは bool マスクで行う
+    mapping_full, singles = compute_single_step_multipliers_oneitem(prices, ports, ports, cash)
+    port_idx = {p: i for i, p in enumerate(ports)}
+    mul = multiplier_matrix(ports, singles)
 
     singles_sorted = sorted(singles, key=lambda x: x[2], reverse=True)
     start_ports_order = []
@@ -328,47 +209,55 @@ def generate_routes_greedy_cover_with_recalc(ports: List[str], price_matrix: Dic
             start_ports_order.append(p)
 
     for initial_start_choice in start_ports_order[:top_k_start]:
-        remaining_ports = set(ports)
+        remaining = np.ones(len(ports), dtype=bool)
         routes = []
         current_start = initial_start_choice
 
         while True:
-            allowed_for_calc = set(remaining_ports) | {current_start}
-            mapping, _ = compute_single_step_multipliers_oneitem(price_matrix, list(allowed_for_calc), list(allowed_for_calc), cash)
+            allowed = remaining.copy()
+            allowed[port_idx[current_start]] = True
 
-            route, steps, final_cash, avg_mul, total_mul = build_greedy_cycles_from_start(current_start, mapping, cash, allowed_ports=allowed_for_calc)
+            route, steps, final_cash, avg_mul, total_mul = build_best_cycle_from_start(current_start, ports, mapping_full, mul, allowed)
             if route is None:
                 break
 
             covered = set(route)
             routes.append({'route': route, 'steps': steps, 'avg_mul': avg_mul, 'total_mul': total_mul, 'covered': covered})
 
-            remaining_ports -= covered
+            for p in covered:
+                remaining[port_idx[p]] = False
 
-            if not remaining_ports:
+            if not remaining.any():
                 break
 
-            mapping_remain, singles_remain = compute_single_step_multipliers_oneitem(price_matrix, list(remaining_ports), list(remaining_ports), cash)
-            next_start = None
-            best_m = -1.0
-            for p in mapping_remain:
-                outs = mapping_remain.get(p, {})
-                if not outs:
-                    continue
-                q, info = max(outs.items(), key=lambda kv: kv[1]['multiplier'])
-                if info['multiplier'] > best_m:
-                    best_m = info['multiplier']
-                    next_start = p
-
-            if next_start is None:
+            # 残り港の中で一手の乗数が最も高い港から次のルートを始める
+            best_out = np.where(remaining, np.where(remaining[None, :], mul, -np.inf).max(axis=1), -np.inf)
+            if not np.isfinite(best_out).any():
                 break
 
-            current_start = next_start
+            current_start = ports[int(np.argmax(best_out))]
 
+        remaining_ports = {ports[i] for i in np.flatnonzero(remaining)}
         results_per_start.append({'initial_start': initial_start_choice, 'routes': routes, 'remaining_ports': remaining_ports})
 
     return results_per_start
 
+# ルート解析と周回の列挙は港数に対して重いので、価格表と所持金が同じあいだは結果を使い回す。
+# スライダーや所持金の入力で再実行されても再計算しない（価格の取得と同じく 60 秒で捨てる）
+@st.cache_data(ttl=60)
+def cached_route_cover(ports: List[str], price_matrix: Dict[str, Dict[str, int]], cash: int, top_k_start: int):
+    prices = PriceTensor.from_matrix(price_matrix, [name for name, _ in ITEMS], ports)
+    return generate_routes_greedy_cover_with_recalc(ports, prices, cash, top_k_start=top_k_start)
+
+@st.cache_data(ttl=60)
+def cached_best_cycles(ports: List[str], price_matrix: Dict[str, Dict[str, int]], cash: int, k: int, max_len: int):
+    # (全体の最良周回, 長さ max_len 以下の上位 k 周回) を返す。どちらも港の添字の列
+    prices = PriceTensor.from_matrix(price_matrix, [name for name, _ in ITEMS], ports)
+    _, singles = compute_single_step_multipliers_oneitem(prices, ports, ports, cash)
+    mul = multiplier_matrix(ports, singles)
+    best_cycle, _ = max_mean_cycle(mul)
+    return best_cycle, [cycle for cycle, _ in top_k_cycles(mul, k=k, max_len=max_len)]
+
 # --------------------
 # メイン: CSV取得と「各港から一手で最適な行き先」「ルート解析」表示（リッチ表示復元）
 # --------------------
@@ -382,9 +271,12 @@ except Exception as e:
     st.error(f"スプレッドシート（CSV）からの読み込みに失敗しました: {e}")
     st.stop()
 
+# 乗数の計算は (品目 x 港) の価格テンソルで全港の組をまとめて行う
+prices = PriceTensor.from_matrix(price_matrix, [name for name, _ in ITEMS], ports)
+
 # 単一遷移プレビュー（内部計算）
 CASH_DEFAULT = 50000
-mapping_preview, candidates_preview = compute_single_step_multipliers_oneitem(price_matrix, ports, ports, CASH_DEFAULT)
+mapping_preview, candidates_preview = compute_single_step_multipliers_oneitem(prices, ports, ports, CASH_DEFAULT)
 
 # --------------------
 # 表示: 各港から一手で最適な行き先（リッチ表示）
@@ -413,8 +305,7 @@ st.subheader("ルート解析（自動）")
 AUTO_TOP_K = 5
 CASH_DEFAULT = 50000
 
-# 単一遷移の候補を並べて開始候補順を作る
-mapping_preview, candidates_preview = compute_single_step_multipliers_oneitem(price_matrix, ports, ports, CASH_DEFAULT)
+# 単一遷移の候補を並べて開始候補順を作る（上の一手プレビューと同じ所持金なのでその結果を使う）
 singles_sorted = sorted(candidates_preview, key=lambda x: x[2], reverse=True)
 start_ports_order = []
 for p, q, m in singles_sorted:
@@ -424,7 +315,7 @@ for p, q, m in singles_sorted:
 start_ports_try = start_ports_order[:AUTO_TOP_K]
 
 with st.spinner("自動解析（複数開始候補）実行中..."):
-    all_results = generate_routes_greedy_cover_with_recalc(ports, price_matrix, CASH_DEFAULT, top_k_start=len(start_ports_try))
+    all_results = cached_route_cover(ports, price_matrix, CASH_DEFAULT, len(start_ports_try))
     kept_results = [r for r in all_results if r['initial_start'] in start_ports_try]
 
 # 集計とリッチ表示（元の見た目に近づける）
@@ -503,4 +394,60 @@ for res in kept_results:
 
         st.write("---")
 
+# --------------------
+# 最適サイクル: 乗数の幾何平均が大きい周回（開始港を問わない上位）
+# --------------------
+st.subheader("最適サイクル（平均乗数の上位）")
+CYCLE_TOP_K = 5
+CYCLE_MAX_LEN = 4
+# 長さを制限しない全体の最良周回（Karp の最大平均閉路）。下の上位表は長さ CYCLE_MAX_LEN 以下に限る
+best_cycle, top_cycles = cached_best_cycles(ports, price_matrix, CASH_DEFAULT, CYCLE_TOP_K, CYCLE_MAX_LEN)
+if best_cycle is not None:
+    route, steps, final_cash, avg_mul, total_mul = route_from_cycle([ports[i] for i in best_cycle], mapping_preview)
+    st.markdown(f"全体の最良周回: **{' → '.join(route)}** — 平均乗数 **{avg_mul:.3f}**")
+cycle_rows = []
+for cycle in top_cycles:
+    route, steps, final_cash, avg_mul, total_mul = route_from_cycle([ports[i] for i in cycle], mapping_preview)
+    cycle_rows.append({
+        "経路": " → ".join(route),
+        "買う物": " / ".join(s.get('chosen_item') or "-" for s in steps),
+        "平均乗数": f"{avg_mul:.3f}",
+        "合計乗数": f"{total_mul:.3f}",
+    })
+if cycle_rows:
+    st.dataframe(pd.DataFrame(cycle_rows), height=max(140, 40 * (len(cycle_rows) + 1)))
+else:
+    st.write("周回できるルートがありません")
+
+# --------------------
+# 複数航海プラン: 所持金を持ち越して N 回航海したあとの所持金が最大の航路
+# --------------------
+st.markdown("---")
+st.subheader("複数航海プラン（所持金を持ち越す）")
+v1, v2, v3 = st.columns(3)
+with v1:
+    voyage_start = st.selectbox("出発港", ports, index=0, key="voyage_start")
+with v2:
+    voyage_cash = numeric_input_optional_strict("所持金", key="voyage_cash", placeholder=f"例: {CASH_DEFAULT}", allow_commas=True, min_value=1)
+with v3:
+    voyage_count = st.slider("航海回数", min_value=1, max_value=10, value=5, key="voyage_count")
+
+voyage_plan = plan_voyages(prices, voyage_start, voyage_cash or CASH_DEFAULT, voyage_count)
+if voyage_plan is None:
+    st.write("航路が見つかりませんでした")
+else:
+    st.markdown(f"**{' → '.join(voyage_plan['route'])}** — 最終所持金 **{voyage_plan['final_cash']:,}**")
+    df_voyage = pd.DataFrame([{
+        "出発": s['from'],
+        "到着": s['to'],
+        "買う物": s['chosen_item'] or "-",
+        "購入数": s['qty'],
+        "到着後の所持金": s['cash_after'],
+        "乗数": s['multiplier'],
+    } for s in voyage_plan['steps']])
+    try:
+        st.dataframe(df_voyage.style.format({"購入数": "{:,.0f}", "到着後の所持金": "{:,.0f}", "乗数": "{:.3f}"}), height=max(140, 40 * (len(df_voyage) + 1)))
+    except Exception:
+        st.table(df_voyage)
+
 st.markdown("※ 表示は一手最適化（単一品目近似）に基づく推定です。実際の運用では在庫・積載・時間等の制約を考慮してください。")
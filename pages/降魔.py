@@ -1,13 +1,73 @@
 # ui/streamlit_app.py
 import streamlit as st
 import html
-from core import kouma_game
+from core import kouma_game, kouma_cache
 import time
 
 st.set_page_config(layout="wide", page_title="Kouma Simulator (Streamlit)")
 
-def empty_board():
-    return [["" for _ in range(7)] for _ in range(7)]
+def empty_board(w=7, h=7):
+    return [["" for _ in range(w)] for _ in range(h)]
+
+def resize_board(board, w, h):
+    # 既存の配置は残したまま盤面サイズだけ変える
+    return [[board[y][x] if y < len(board) and x < len(board[0]) else "" for x in range(w)] for y in range(h)]
+
+def safe_rerun():
+    # 新しい Streamlit は st.rerun、古いものは st.experimental_rerun
+    rerun = getattr(st, "rerun", None) or getattr(st, "experimental_rerun", None)
+    if rerun is not None:
+        rerun()
+
+CELL_PX = 60
+
+def board_to_svg(board, path):
+    board_h = len(board)
+    board_w = len(board[0])
+    cell_w = cell_h = CELL_PX
+    svg_w = cell_w * board_w
+    svg_h = cell_h * board_h
+    svg = []
+    svg.append(f'<svg width="{svg_w}" height="{svg_h}" viewBox="0 0 {svg_w} {svg_h}" xmlns="http://www.w3.org/2000/svg">')
+    svg.append(f'<rect width="100%" height="100%" fill="#111"/>')
+    for i in range(board_w + 1):
+        x = i * cell_w
+        svg.append(f'<line x1="{x}" y1="0" x2="{x}" y2="{svg_h}" stroke="#333" stroke-width="1"/>')
+    for i in range(board_h + 1):
+        y = i * cell_h
+        svg.append(f'<line x1="0" y1="{y}" x2="{svg_w}" y2="{y}" stroke="#333" stroke-width="1"/>')
+    for yy in range(board_h):
+        for xx in range(board_w):
+            cx = xx * cell_w + cell_w/2
+            cy = yy * cell_h + cell_h/2
+            val = board[yy][xx]
+            if val == "P":
+                svg.append(f'<text x="{cx}" y="{cy+6}" text-anchor="middle" font-size="18" fill="#fff" font-weight="bold">P</text>')
+            elif val and val.startswith("B"):
+                svg.append(f'<text x="{cx}" y="{cy+6}" text-anchor="middle" font-size="18" fill="#ffd54f" font-weight="bold">{html.escape(val[1:])}</text>')
+            elif val in ["R","G","B","Y"]:
+                color_map = {"R":"#ef5350","G":"#66bb6a","B":"#42a5f5","Y":"#ffd54f"}
+                svg.append(f'<circle cx="{cx}" cy="{cy}" r="{cell_w*0.12}" fill="{color_map[val]}"/>')
+            elif val and val.startswith("T_"):
+                color = val[2]
+                color_map = {"R":"#ef5350","G":"#66bb6a","B":"#42a5f5","Y":"#ffd54f"}
+                svg.append(f"<rect x='{cx-8}' y='{cy-8}' width='16' height='16' fill='{color_map.get(color, '#999')}' />")
+            elif val == "X":
+                svg.append(f'<text x="{cx}" y="{cy+6}" text-anchor="middle" font-size="18" fill="#fff">×</text>')
+    if len(path) > 1:
+        points = []
+        for (x,y) in path:
+            px = x * cell_w + cell_w/2
+            py = y * cell_h + cell_h/2
+            points.append(f"{px},{py}")
+        points_str = " ".join(points)
+        svg.append(f'<polyline points="{points_str}" fill="none" stroke="yellow" stroke-width="6" stroke-linecap="round" stroke-linejoin="round" opacity="0.95"/>')
+        for (x,y) in path:
+            px = x * cell_w + cell_w/2
+            py = y * cell_h + cell_h/2
+            svg.append(f'<circle cx="{px}" cy="{py}" r="4" fill="#fff" />')
+    svg.append('</svg>')
+    return "\n".join(svg)
 
 if "board" not in st.session_state:
     st.session_state.board = empty_board()
@@ -18,6 +78,15 @@ if "last_result" not in st.session_state:
 
 st.title("Kouma Simulator — Streamlit")
 
+# --- 盤面サイズ（イベントによっては 7x7 より大きい） ---
+with st.sidebar:
+    st.markdown("**盤面サイズ**")
+    board_w = int(st.number_input("横", min_value=3, max_value=12, value=len(st.session_state.board[0]), step=1))
+    board_h = int(st.number_input("縦", min_value=3, max_value=12, value=len(st.session_state.board), step=1))
+if (board_w, board_h) != (len(st.session_state.board[0]), len(st.session_state.board)):
+    st.session_state.board = resize_board(st.session_state.board, board_w, board_h)
+    st.session_state.last_result = None
+
 # --- パレット（盤面上部に表示） ---
 palette_items = [
     ("P", "P"),
@@ -47,12 +116,12 @@ st.markdown(f"**選択中:** {st.session_state.selected}")
 
 st.markdown("---")
 
-# --- 盤面表示（7x7） ---
+# --- 盤面表示 ---
 board_cols = []
-for y in range(7):
-    row_cols = st.columns(7)
+for y in range(board_h):
+    row_cols = st.columns(board_w)
     board_cols.append(row_cols)
-    for x in range(7):
+    for x in range(board_w):
         key = f"cell_{x}_{y}"
         val = st.session_state.board[y][x]
         label = val if val else "・"
@@ -65,8 +134,8 @@ for y in range(7):
             # プレイヤーは一つだけ
             elif sel == "P":
                 # 既存の P を消す
-                for yy in range(7):
-                    for xx in range(7):
+                for yy in range(board_h):
+                    for xx in range(board_w):
                         if st.session_state.board[yy][xx] == "P":
                             st.session_state.board[yy][xx] = ""
                 st.session_state.board[y][x] = "P"
@@ -79,22 +148,69 @@ for y in range(7):
 
 st.markdown("---")
 
+# --- 探索設定 ---
+with st.sidebar:
+    st.markdown("**探索設定**")
+    time_budget_ms = st.number_input("制限時間 (ms)", min_value=50, max_value=60000, value=500, step=50)
+    max_steps = st.number_input("最大ステップ数", min_value=1000, max_value=5000000, value=200000, step=10000)
+    beam_width = st.number_input("ビーム幅", min_value=10, max_value=5000, value=300, step=10)
+    tt_size_mb = st.number_input("置換表サイズ (MB)", min_value=1, max_value=1024, value=64, step=8)
+    top_k = st.number_input("保持する同点経路数", min_value=1, max_value=1000, value=kouma_game.BEST_K, step=10)
+
 # --- 実行ボタン ---
-if st.button("シミュレーション実行"):
-    board_input = st.session_state.board
-    boss_counter = [0]
-    parsed = []
-    for row in board_input:
-        parsed_row = []
-        for s in row:
-            parsed_row.append(kouma_game.parse_cell(s if s else "", boss_counter))
-        parsed.append(parsed_row)
+def run_solve(board, session, options, progress=None):
+    # 1 マスだけ変えた盤面は前回の探索（暫定解と置換表）を引き継いで解き直す。
+    # 別スレッドで動くので st.session_state には触らず、新しい session は返り値で渡す
+    holder = {"session": session}
+
+    def warm_solver(b, mode=None, **kwargs):
+        on_sample = progress.sample if progress is not None else None
+        best, stats, holder["session"] = kouma_game.simulate_board_warm(b, session=session, progress=progress, on_sample=on_sample, **kwargs)
+        return best, stats
 
     t0 = time.time()
-    results, stats = kouma_game.simulate_board(parsed, mode="memo", max_steps=max_steps, beam_width=beam_width)
-    t1 = time.time()
-    stats["wall_time_ms"] = int((t1 - t0) * 1000)
-    st.session_state.last_result = {"paths": results, "stats": stats}
+    # 同じ盤面・鏡像/回転した盤面の再実行はキャッシュから即座に返る
+    results, stats = kouma_cache.simulate_board_cached(board, solver=warm_solver, mode="memo", **options)
+    stats["wall_time_ms"] = int((time.time() - t0) * 1000)
+    return results, stats, holder["session"]
+
+job = st.session_state.get("solve_job")
+if st.button("シミュレーション実行", disabled=job is not None and job.running):
+    options = {"max_steps": int(max_steps), "beam_width": int(beam_width), "time_budget_ms": int(time_budget_ms), "tt_size_mb": int(tt_size_mb), "top_k": int(top_k)}
+    board_snapshot = [row[:] for row in st.session_state.board]
+    job = kouma_game.SolveJob(run_solve, kouma_game.parse_board(board_snapshot), st.session_state.get("solve_session"), options)
+    st.session_state.solve_job = job
+    st.session_state.solve_board = board_snapshot
+    st.session_state.last_result = None
+
+# --- 探索中: 途中経過を表示して定期的に再描画 ---
+if job is not None and job.running:
+    snap = job.progress.snapshot()
+    st.subheader("探索中…")
+    c1, c2, c3 = st.columns(3)
+    c1.metric("訪問ノード数", f"{snap['nodes_visited']:,}")
+    c2.metric("暫定ボス数", snap["best_bosses"])
+    c3.metric("経過時間", f"{snap['elapsed_ms'] / 1000:.1f} s")
+    counts = snap["counts"]
+    if counts:
+        c4, c5, c6 = st.columns(3)
+        c4.metric("ノード/秒", f"{counts['nodes_per_sec']:,}")
+        c5.metric("生成ノード数", f"{counts['generated']:,}")
+        c6.metric("スタック長", f"{counts['stack']:,}")
+    if st.button("キャンセル（暫定解を残す）"):
+        job.cancel()
+    solve_board = st.session_state.solve_board
+    st.components.v1.html(board_to_svg(solve_board, snap["best_path"]), height=CELL_PX * len(solve_board) + 10)
+    time.sleep(0.3)
+    safe_rerun()
+elif job is not None:
+    st.session_state.solve_job = None
+    if job.error is not None:
+        st.error(f"探索中にエラーが発生しました: {job.error}")
+    else:
+        results, stats, session = job.result
+        st.session_state.solve_session = session
+        st.session_state.last_result = {"paths": results, "stats": stats, "board": st.session_state.solve_board}
 
 # --- 結果表示と SVG 描画 ---
 if st.session_state.last_result:
@@ -105,60 +221,42 @@ if st.session_state.last_result:
     if not paths:
         st.write("経路が見つかりませんでした。")
     else:
+        if "optimal_paths" in stats:
+            if stats.get("optimal_paths_exact"):
+                st.markdown(f"同点の最適経路: **{stats['optimal_paths']:,}** 本（上位 {len(paths)} 本を保持）")
+            else:
+                # 置換表のある探索・打ち切った探索では合流や重複があり、経路数は正確に数えられない
+                st.markdown(f"同点の最適経路: 約 **{stats['optimal_paths']:,}** 本（概数。上位 {len(paths)} 本を保持）")
         for i, s in enumerate(paths[:5]):
             moves = s.path
             distance = max(0, len(moves) - 1)
             st.markdown(f"**候補 {i+1}** — 倒したボス数: **{s.boss_killed}**, 経路長: **{distance}**, 最終攻撃力: **{s.attack}**")
+        if stats.get("proven_optimal"):
+            st.success("探索を完了しました（最適解）")
+        elif stats.get("cancelled"):
+            st.warning("キャンセルしました（暫定解）")
+        else:
+            st.warning("制限時間または最大ステップ数で打ち切りました（暫定解）")
         st.markdown("**探索統計**")
-        st.write(stats)
-
-        svg_w = 420
-        svg_h = 420
-        cell_w = svg_w / 7
-        cell_h = svg_h / 7
-
-        def board_to_svg(board, path_states):
-            svg = []
-            svg.append(f'<svg width="{svg_w}" height="{svg_h}" viewBox="0 0 {svg_w} {svg_h}" xmlns="http://www.w3.org/2000/svg">')
-            svg.append(f'<rect width="100%" height="100%" fill="#111"/>')
-            for i in range(8):
-                x = i * cell_w
-                y = i * cell_h
-                svg.append(f'<line x1="{x}" y1="0" x2="{x}" y2="{svg_h}" stroke="#333" stroke-width="1"/>')
-                svg.append(f'<line x1="0" y1="{y}" x2="{svg_w}" y2="{y}" stroke="#333" stroke-width="1"/>')
-            for yy in range(7):
-                for xx in range(7):
-                    cx = xx * cell_w + cell_w/2
-                    cy = yy * cell_h + cell_h/2
-                    val = st.session_state.board[yy][xx]
-                    if val == "P":
-                        svg.append(f'<text x="{cx}" y="{cy+6}" text-anchor="middle" font-size="18" fill="#fff" font-weight="bold">P</text>')
-                    elif val and val.startswith("B"):
-                        svg.append(f'<text x="{cx}" y="{cy+6}" text-anchor="middle" font-size="18" fill="#ffd54f" font-weight="bold">{html.escape(val[1:])}</text>')
-                    elif val in ["R","G","B","Y"]:
-                        color_map = {"R":"#ef5350","G":"#66bb6a","B":"#42a5f5","Y":"#ffd54f"}
-                        svg.append(f'<circle cx="{cx}" cy="{cy}" r="{cell_w*0.12}" fill="{color_map[val]}"/>')
-                    elif val and val.startswith("T_"):
-                        color = val[2]
-                        color_map = {"R":"#ef5350","G":"#66bb6a","B":"#42a5f5","Y":"#ffd54f"}
-                        svg.append(f"<rect x='{cx-8}' y='{cy-8}' width='16' height='16' fill='{color_map.get(color, '#999')}' />")
-                    elif val == "X":
-                        svg.append(f'<text x="{cx}" y="{cy+6}" text-anchor="middle" font-size="18" fill="#fff">×</text>')
-            first = path_states[0].path
-            if len(first) > 1:
-                points = []
-                for (x,y) in first:
-                    px = x * cell_w + cell_w/2
-                    py = y * cell_h + cell_h/2
-                    points.append(f"{px},{py}")
-                points_str = " ".join(points)
-                svg.append(f'<polyline points="{points_str}" fill="none" stroke="yellow" stroke-width="6" stroke-linecap="round" stroke-linejoin="round" opacity="0.95"/>')
-                for (x,y) in first:
-                    px = x * cell_w + cell_w/2
-                    py = y * cell_h + cell_h/2
-                    svg.append(f'<circle cx="{px}" cy="{py}" r="4" fill="#fff" />')
-            svg.append('</svg>')
-            return "\n".join(svg)
-
-        svg_html = board_to_svg(st.session_state.board, paths)
-        st.components.v1.html(svg_html, height=svg_h+10)
+        # max_steps / beam_width の調整用: 展開と生成、枝刈りの理由ごとの件数
+        c1, c2, c3, c4 = st.columns(4)
+        c1.metric("展開ノード数", f"{stats.get('nodes_visited', 0):,}")
+        c2.metric("生成ノード数", f"{stats.get('nodes_generated', 0):,}")
+        c3.metric("ノード/秒", f"{stats.get('nodes_per_sec', 0):,}")
+        c4.metric("最大スタック長", f"{stats.get('max_stack_depth', 0):,}")
+        c1, c2, c3, c4 = st.columns(4)
+        c1.metric("置換表ヒット率", f"{stats.get('tt_hit_rate', 0):.1%}")
+        c2.metric("上界で枝刈り", f"{stats.get('bound_pruned', 0):,}")
+        c3.metric("置換表・支配で枝刈り", f"{stats.get('memo_dominated', 0):,} / {stats.get('pareto_dominated', 0):,}")
+        # ru_maxrss は起動からのプロセス全体（Streamlit 本体を含む）の最大値で、この探索だけの使用量ではない
+        rss = stats.get("peak_rss_mb")
+        c4.metric("プロセスの最大メモリ", "-" if rss is None else f"{rss:,.1f} MB", help="アプリ起動からのプロセス全体の最大常駐メモリ（この探索だけの値ではない）")
+        st.markdown(
+            f"進めなかった手: 訪問済み **{stats.get('pruned_visited', 0):,}** / "
+            f"色ロック **{stats.get('pruned_lock', 0):,}** / 攻撃力不足 **{stats.get('pruned_hp', 0):,}**"
+        )
+        with st.expander("すべての統計"):
+            st.write(stats)
+
+        solve_board = res.get("board", st.session_state.board)
+        st.components.v1.html(board_to_svg(solve_board, paths[0].path), height=CELL_PX * len(solve_board) + 10)